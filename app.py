@@ -1,16 +1,33 @@
 # app.py
 
+import time
+# Отсчет времени запуска: все, что ниже, входит в фазу импорта модулей
+PROCESS_STARTED = time.perf_counter()
+
 import asyncio
 import logging
 import signal
 from aiogram import Bot, Dispatcher
 from aiogram.types import BotCommand, BotCommandScopeChat
-from aiogram.fsm.storage.memory import MemoryStorage
-from config.config import BOT_TOKEN, ADMIN_IDS
-from handlers.admin.admin_handlers import admin_router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from config.config import BOT_TOKEN, ADMIN_IDS, BOT_MODE, TELEGRAM_API_URL, METRICS_PORT
+from handlers.admin.admin_handlers import admin_router, resume_broadcasts
 from handlers.users.user_handlers import user_router
 from middlewares.subscription import SubscriptionMiddleware
-from db.database import init_db
+from middlewares.throttling import ThrottlingMiddleware
+from middlewares.context import ContextMiddleware
+from middlewares.metrics import RequestMetricsMiddleware, setup_metrics
+from db.database import init_db, open_db, close_db
+from db.active_game import active_game
+from db.fsm_storage import SQLiteStorage
+from utils.scoring import scorer
+from utils.metrics import start_metrics, stop_metrics
+from utils.jobs import jobs
+from utils.webhook import run_webhook
+from utils.startup import StartupTimer
+
+IMPORTS_DONE = time.perf_counter()
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,34 +47,81 @@ async def set_commands(bot: Bot):
         BotCommand(command="startgame", description="Запустить первую игру"),
         BotCommand(command="continuegame", description="Запустить следующую игру"),
         BotCommand(command="stopgame", description="Остановить игру"),
+        BotCommand(command="jobs", description="Фоновые задачи"),
+        BotCommand(command="canceljob", description="Отменить фоновую задачу"),
         BotCommand(command="excel", description="Экспорт результатов"),
         BotCommand(command="senduser", description="Отправить сообщение пользователю")
     ]
 
-    # Установка команд для всех пользователей
-    await bot.set_my_commands(user_commands)
+    # Команды для всех пользователей и расширенные команды для каждого админа устанавливаются параллельно
+    scopes = [None] + list(ADMIN_IDS)
+    results = await asyncio.gather(
+        bot.set_my_commands(user_commands),
+        *(bot.set_my_commands(admin_commands, scope=BotCommandScopeChat(chat_id=admin_id)) for admin_id in ADMIN_IDS),
+        return_exceptions=True
+    )
+    for admin_id, result in zip(scopes, results):
+        if not isinstance(result, Exception):
+            continue
+        if admin_id is None:
+            logging.error(f"Could not set commands: {result}")
+        else:
+            logging.error(f"Could not set commands for admin {admin_id}: {result}")
+
+# Фоновая регистрация команд: ссылка держится до завершения, при остановке задача отменяется
+_commands_task = None
+
 
-    # Установка расширенных команд для админов
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.set_my_commands(admin_commands, scope=BotCommandScopeChat(chat_id=admin_id))
-        except Exception as e:
-            logging.error(f"Could not set commands for admin {admin_id}: {e}")
+async def on_startup(bot: Bot, worker_index: int = 0):
+    global _commands_task
+    timer = StartupTimer(PROCESS_STARTED)
+    timer.mark('imports', IMPORTS_DONE - PROCESS_STARTED)
 
+    async def bootstrap_db():
+        await timer.measure('open_db', open_db())
+        await timer.measure('init_db', init_db())
+        await timer.measure('active_game', active_game.reload(notify=False))
 
-async def on_startup(bot: Bot):
-    await init_db()
-    await set_commands(bot)
+    # БД, пул оценки и сервер метрик друг от друга не зависят и поднимаются одновременно.
+    # У каждого воркера supervisor.py свой порт метрик
+    await asyncio.gather(
+        bootstrap_db(),
+        timer.measure('scorer', scorer.start()),
+        timer.measure('metrics', start_metrics(METRICS_PORT + worker_index if METRICS_PORT else 0)),
+    )
+    # При запуске через supervisor.py команды регистрирует и рассылки досылает только один воркер
+    # (он же обрабатывает команды администратора)
+    if worker_index == 0:
+        # Команды в меню не нужны для обработки обновлений: регистрируем их в фоне
+        _commands_task = asyncio.create_task(timer.measure('set_commands', set_commands(bot)))
+        await timer.measure('resume_broadcasts', resume_broadcasts(bot))
+    timer.report()
     logger.info("Бот запущен")
 
 async def on_shutdown(bot: Bot):
+    global _commands_task
     logger.info("Бот останавливается")
+    if _commands_task is not None:
+        _commands_task.cancel()
+        _commands_task = None
+    # Незавершенные задачи администратора отменяются до закрытия БД
+    await jobs.stop()
+    await stop_metrics()
+    await scorer.stop()
+    await close_db()
 
-async def main():
-    # Объект бота
-    bot = Bot(token=BOT_TOKEN)
-    # Диспетчер
-    storage = MemoryStorage()
+def create_bot():
+    session = None
+    if TELEGRAM_API_URL:
+        # Свой сервер Bot API (например, локальный или тестовый)
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    bot = Bot(token=BOT_TOKEN, session=session)
+    bot.session.middleware(RequestMetricsMiddleware())
+    return bot
+
+def create_dispatcher():
+    # Состояния хранятся в SQLite и переживают перезапуск бота
+    storage = SQLiteStorage()
     dp = Dispatcher(storage=storage)
 
     # Регистрируем роутеры
@@ -66,9 +130,35 @@ async def main():
     dp.include_router(admin_router)
     dp.include_router(user_router)
 
+    # Ограничение частоты запросов пользователей: внутренний middleware видит флаги хендлера
+    throttling = ThrottlingMiddleware()
+    user_router.message.middleware(throttling)
+    user_router.callback_query.middleware(throttling)
+
+    # Данные пользователя и его участие в активной игре — одним запросом на обновление.
+    # Регистрируется после ограничения частоты, поэтому отброшенные обновления БД не читают
+    context = ContextMiddleware()
+    user_router.message.middleware(context)
+    user_router.callback_query.middleware(context)
+
+    # Замеры времени обновлений и хендлеров для /metrics
+    setup_metrics(dp)
+
     # Регистрируем функции startup и shutdown
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
+    return dp
+
+async def main():
+    bot = create_bot()
+    dp = create_dispatcher()
+
+    if BOT_MODE == 'webhook':
+        await run_webhook(dp, bot)
+        return
+
+    # Если раньше бот работал через вебхук, getUpdates вернет ошибку, пока вебхук не снят
+    await bot.delete_webhook()
 
     # Добавляем обработчики сигналов для graceful shutdown
     loop = asyncio.get_running_loop()
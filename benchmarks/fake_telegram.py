@@ -0,0 +1,161 @@
+"""
+Локальный поддельный сервер Bot API для офлайн-проверок и бенчмарков.
+
+Бот подключается к нему через TELEGRAM_API_URL. Сервер отвечает на методы Bot API правдоподобными
+объектами, записывает все исходящие вызовы, отдает обновления через getUpdates и умеет
+имитировать задержку сети и ответы 429 (flood control).
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from aiohttp import web
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+
+def user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+
+def chat(user_id):
+    return {"id": user_id, "type": "private", "first_name": f"User{user_id}"}
+
+
+def message_update(update_id, user_id, text=None, contact=None):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": chat(user_id),
+        "from": user(user_id),
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith('/'):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if contact is not None:
+        message["contact"] = {"phone_number": contact, "first_name": f"User{user_id}", "user_id": user_id}
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": chat(user_id),
+                "from": BOT_USER,
+                "text": "menu",
+            },
+        },
+    }
+
+
+class FakeTelegram:
+    def __init__(self, token, latency=0.0, flood_every=0, retry_after=1):
+        self.token = token
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.calls = []
+        self.counts = Counter()
+        self._message_ids = itertools.count(1)
+        self._updates = []
+        self._update_event = asyncio.Event()
+        self._waiters = []
+        self._runner = None
+        self.url = None
+
+    def push_updates(self, updates):
+        self._updates.extend(updates)
+        self._update_event.set()
+
+    async def wait_for(self, method, count, timeout=60.0):
+        """Ждет, пока метод будет вызван count раз. Возвращает время ожидания."""
+        started = time.perf_counter()
+        deadline = started + timeout
+        while self.counts[method] < count:
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"{method}: {self.counts[method]} из {count} вызовов за {timeout} с")
+            await asyncio.sleep(0.005)
+        return time.perf_counter() - started
+
+    def _message(self, params):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": chat(int(params.get("chat_id", 0))),
+            "from": BOT_USER,
+            "text": params.get("text") or params.get("caption") or "",
+        }
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        deadline = time.monotonic() + timeout
+        while True:
+            pending = [update for update in self._updates if update["update_id"] >= offset]
+            if offset:
+                # Подтвержденные обновления больше не храним
+                self._updates = pending
+            if pending or time.monotonic() >= deadline:
+                return pending[:100]
+            self._update_event.clear()
+            try:
+                await asyncio.wait_for(self._update_event.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        self.calls.append((method, params, time.perf_counter()))
+        if method != 'getUpdates' and self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method in ('sendMessage', 'sendPhoto') and self.flood_every:
+            if (self.counts['_sent'] + 1) % self.flood_every == 0:
+                self.counts['_sent'] += 1
+                self.counts['429'] += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                })
+            self.counts['_sent'] += 1
+
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'getUpdates':
+            result = await self._get_updates(params)
+        elif method in ('sendMessage', 'sendPhoto', 'editMessageText'):
+            result = self._message(params)
+        elif method == 'getChatMember':
+            result = {"status": "member", "user": user(int(params.get("user_id", 0)))}
+        else:
+            result = True
+        self.counts[method] += 1
+        return web.json_response({"ok": True, "result": result}, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_post(f'/bot{self.token}/{{method}}', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,321 @@
+"""
+Сквозной нагрузочный тест: настоящий диспетчер с admin_router и user_router, но без сети.
+
+Бот работает через FakeSession — сессию aiogram, которая отвечает на методы Bot API в памяти,
+записывает все исходящие вызовы и умеет имитировать задержку и ответы 429. База временная.
+
+Сценарий:
+  1. регистрация: N пользователей присылают /start, подписываются на канал
+     (кнопка «Я подписался») и делятся номером телефона;
+  2. администратор создает игру (/makegame, фото, промпт) и запускает ее (/startgame);
+  3. игра: каждый пользователь нажимает «Да, начинаем!» и присылает свой промпт;
+  4. администратор останавливает игру (/stopgame), итоги рассылаются участникам.
+
+Для каждой фазы печатается число обновлений в секунду и p50/p95/p99 времени обработки
+обновления, суммарное время в функциях db.database (сумма по всем вызовам, включая
+параллельные и ожидание свободного соединения) и число вызовов Bot API.
+Результат сравнивается с сохраненным базовым прогоном (benchmarks/baselines/load_test.json):
+если пропускная способность упала или p95 выросло больше чем на --tolerance, тест завершается
+с ошибкой.
+
+Запуск: python -m benchmarks.load_test --users 10000
+Обновить базовый прогон: python -m benchmarks.load_test --save-baseline
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'load_test.json')
+TOKEN = '123456:FAKE-TOKEN-FOR-BENCHMARKS'
+ADMIN_ID = 1
+
+WORDS = ['cat', 'dog', 'hat', 'red', 'blue', 'forest', 'city', 'night', 'neon', 'portrait', 'oil painting',
+         'кот', 'собака', 'шляпа', 'закат', 'город', 'ночь', 'акварель', 'портрет', 'в стиле аниме']
+PROMPT = 'a red cat in a hat, oil painting, city at night'
+# Содержимое любого файла, который бот скачивает через FakeSession
+FILE_CONTENT = b'\x89PNG\r\n\x1a\n' + bytes(64 * 1024)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def photo_update(update_id, user_id):
+    from benchmarks.fake_telegram import message_update
+    update = message_update(update_id, user_id)
+    update['message']['photo'] = [{'file_id': 'photo-1', 'file_unique_id': 'p1', 'width': 512, 'height': 512}]
+    return update
+
+
+def make_session_class():
+    from aiogram.client.session.base import BaseSession
+    from benchmarks.fake_telegram import BOT_USER, chat, user
+
+    class FakeSession(BaseSession):
+        """
+        Сессия aiogram без сети. Ответ собирается как JSON Bot API и разбирается штатным
+        check_response, так что хендлеры получают такие же объекты и исключения, как в бою.
+        """
+
+        def __init__(self, latency=0.0, flood_every=0, retry_after=1):
+            super().__init__()
+            self.latency = latency
+            self.flood_every = flood_every
+            self.retry_after = retry_after
+            self.counts = Counter()
+            self.subscribed = set()
+            self._sent = 0
+            self._message_id = 0
+
+        def _result(self, name, method):
+            if name == 'getMe':
+                return BOT_USER
+            if name in ('sendMessage', 'sendPhoto', 'editMessageText'):
+                self._message_id += 1
+                return {
+                    'message_id': self._message_id,
+                    'date': int(time.time()),
+                    'chat': chat(int(getattr(method, 'chat_id', None) or 0)),
+                    'from': BOT_USER,
+                    'text': getattr(method, 'text', None) or getattr(method, 'caption', None) or '',
+                }
+            if name == 'getChatMember':
+                status = 'member' if method.user_id in self.subscribed else 'left'
+                return {'status': status, 'user': user(method.user_id)}
+            return True
+
+        async def make_request(self, bot, method, timeout=None):
+            name = method.__api_method__
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if name in ('sendMessage', 'sendPhoto') and self.flood_every:
+                self._sent += 1
+                if self._sent % self.flood_every == 0:
+                    self.counts['429'] += 1
+                    content = json.dumps({
+                        'ok': False, 'error_code': 429,
+                        'description': f'Too Many Requests: retry after {self.retry_after}',
+                        'parameters': {'retry_after': self.retry_after},
+                    })
+                    self.check_response(bot, method, 429, content)
+            self.counts[name] += 1
+            content = json.dumps({'ok': True, 'result': self._result(name, method)}, ensure_ascii=False)
+            return self.check_response(bot, method, 200, content).result
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            # Скачивание файла (bot.download): отдаем фиксированное содержимое порциями по chunk_size
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            self.counts['download'] += 1
+            for start in range(0, len(FILE_CONTENT), chunk_size):
+                yield FILE_CONTENT[start:start + chunk_size]
+
+        async def close(self):
+            pass
+
+    return FakeSession
+
+
+class LoadTest:
+    def __init__(self, args):
+        from aiogram import Bot
+        from app import create_dispatcher
+        from middlewares.metrics import RequestMetricsMiddleware
+
+        self.args = args
+        self.session = make_session_class()(args.latency, args.flood_every, args.retry_after)
+        self.bot = Bot(token=TOKEN, session=self.session)
+        self.bot.session.middleware(RequestMetricsMiddleware())
+        self.dp = create_dispatcher()
+        self.update_id = 0
+        self.errors = 0
+        self.phases = []
+        self.rng = random.Random(args.seed)
+
+    def _next_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    async def feed(self, raw, latencies):
+        from aiogram.types import Update
+        update = Update.model_validate(raw, context={'bot': self.bot})
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            self.errors += 1
+        latencies.append(time.perf_counter() - started)
+
+    async def run_users(self, script, latencies):
+        """Пользователи действуют параллельно (не больше --concurrency одновременно), каждый — по порядку."""
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def one(user_id):
+            async with semaphore:
+                for raw in script(user_id):
+                    await self.feed(raw, latencies)
+
+        await asyncio.gather(*(one(user_id) for user_id in self.user_ids))
+
+    async def wait_background(self):
+        # Остановка и запуск игры идут фоновыми задачами администратора
+        from utils.jobs import jobs
+        await jobs.wait()
+
+    async def phase(self, name, coro_factory):
+        from utils.metrics import DB_SECONDS
+        db_before = sum(total for total, _ in DB_SECONDS.totals().values())
+        calls_before = sum(self.session.counts.values())
+        latencies = []
+        started = time.perf_counter()
+        await coro_factory(latencies)
+        await self.wait_background()
+        elapsed = time.perf_counter() - started
+        db_time = sum(total for total, _ in DB_SECONDS.totals().values()) - db_before
+        result = {
+            'phase': name,
+            'updates': len(latencies),
+            'seconds': round(elapsed, 3),
+            'updates_per_s': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'db_s': round(db_time, 3),
+            'api_calls': sum(self.session.counts.values()) - calls_before,
+        }
+        self.phases.append(result)
+        print(f"{name:12s} {result['updates']:7d} обн. за {result['seconds']:7.2f} с  "
+              f"{result['updates_per_s']:8.1f} обн./с  p50 {result['p50_ms']:7.2f}  p95 {result['p95_ms']:7.2f}  "
+              f"p99 {result['p99_ms']:7.2f} мс  в БД {result['db_s']:8.2f} с  вызовов API {result['api_calls']}")
+        return result
+
+    def registration(self, user_id):
+        from benchmarks.fake_telegram import message_update, callback_update
+        yield message_update(self._next_id(), user_id, '/start')
+        self.session.subscribed.add(user_id)
+        yield callback_update(self._next_id(), user_id, 'check_subscription_again')
+        yield message_update(self._next_id(), user_id, contact=f'+7900{user_id:07d}')
+
+    def game(self, user_id):
+        from benchmarks.fake_telegram import message_update, callback_update
+        yield callback_update(self._next_id(), user_id, 'play_now')
+        prompt = ' '.join(self.rng.sample(WORDS, self.rng.randint(3, 8)))
+        yield message_update(self._next_id(), user_id, prompt)
+
+    async def admin(self, updates, latencies):
+        for raw in updates:
+            await self.feed(raw, latencies)
+
+    async def run(self):
+        from benchmarks.fake_telegram import message_update
+        self.user_ids = [1_000_000 + i for i in range(self.args.users)]
+        await self.dp.emit_startup(bot=self.bot)
+        try:
+            await self.phase('регистрация', lambda lat: self.run_users(self.registration, lat))
+            await self.phase('старт игры', lambda lat: self.admin([
+                message_update(self._next_id(), ADMIN_ID, '/makegame'),
+                photo_update(self._next_id(), ADMIN_ID),
+                message_update(self._next_id(), ADMIN_ID, PROMPT),
+                message_update(self._next_id(), ADMIN_ID, '/startgame'),
+            ], lat))
+            await self.phase('игра', lambda lat: self.run_users(self.game, lat))
+            await self.phase('итоги', lambda lat: self.admin([
+                message_update(self._next_id(), ADMIN_ID, '/stopgame'),
+            ], lat))
+        finally:
+            await self.dp.emit_shutdown(bot=self.bot)
+
+        # Исключение в задаче смены раунда не доходит до диспетчера: считаем такие задачи отдельно
+        from utils.jobs import jobs, DONE
+        self.errors += sum(1 for job in jobs.recent() if job.status != DONE)
+        user_phases = [p for p in self.phases if p['phase'] in ('регистрация', 'игра')]
+        updates = sum(p['updates'] for p in user_phases)
+        seconds = sum(p['seconds'] for p in user_phases)
+        summary = {
+            'params': {
+                'users': self.args.users,
+                'latency': self.args.latency,
+                'flood_every': self.args.flood_every,
+                'concurrency': self.args.concurrency,
+                'scoring_mode': os.environ.get('SCORING_MODE', 'inline'),
+            },
+            'updates_per_s': round(updates / seconds, 1) if seconds else 0.0,
+            'p95_ms': max(p['p95_ms'] for p in user_phases),
+            'errors': self.errors,
+            'api_calls': dict(self.session.counts),
+            'phases': self.phases,
+        }
+        print(f"Итого: {summary['updates_per_s']} обн./с по пользовательским фазам, "
+              f"худший p95 {summary['p95_ms']} мс, ошибок {self.errors}, 429: {self.session.counts['429']}")
+        return summary
+
+
+def compare(summary, baseline, tolerance):
+    """Возвращает список регрессий относительно базового прогона."""
+    if baseline['params'] != summary['params']:
+        print("Параметры прогона отличаются от базового, сравнение пропущено")
+        return []
+    problems = []
+    if summary['updates_per_s'] < baseline['updates_per_s'] * (1 - tolerance):
+        problems.append(f"пропускная способность {summary['updates_per_s']} < {baseline['updates_per_s']} обн./с")
+    if summary['p95_ms'] > baseline['p95_ms'] * (1 + tolerance):
+        problems.append(f"p95 {summary['p95_ms']} > {baseline['p95_ms']} мс")
+    if summary['errors'] > baseline['errors']:
+        problems.append(f"ошибок {summary['errors']} > {baseline['errors']}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=500, help="сколько пользователей действуют одновременно")
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument('--flood-every', type=int, default=0, help="каждый N-й sendMessage получает 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Конфигурация читается при импорте, поэтому окружение задается до импорта бота
+        os.environ.update({
+            'BOT_TOKEN': TOKEN,
+            'ADMIN_IDS': str(ADMIN_ID),
+            'CHANNEL_ID': '-1000000000000',
+            'DB_PATH': os.path.join(tmp, 'load.db'),
+            'EXPORT_CACHE_DIR': os.path.join(tmp, 'exports'),
+            'METRICS_PORT': '0',
+        })
+        # Лимиты Telegram на рассылку здесь не проверяются: их задает FakeSession (--flood-every)
+        os.environ.setdefault('BROADCAST_RATE', '100000')
+        os.environ.setdefault('BROADCAST_PER_CHAT_INTERVAL', '0')
+        summary = asyncio.run(LoadTest(args).run())
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"Базовый прогон сохранен в {args.baseline}")
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            problems = compare(summary, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"РЕГРЕССИЯ: {problem}")
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
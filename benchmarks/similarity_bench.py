@@ -0,0 +1,244 @@
+"""
+Бенчмарк и проверка точности оценки ответов (utils/similarity.py).
+
+Корпус benchmarks/data/similarity_corpus.json — фиксированный набор пар «эталон — ответ»
+на русском и английском (и смешанных) разной длины с ожидаемым баллом 0–100 текущей реализации.
+
+Что делает:
+  * проверяет, что _calculate_similarity по-прежнему дает ожидаемые баллы;
+  * сравнивает с ней альтернативные оценщики (профиль эталона) по tau Кендалла: насколько
+    сохраняется порядок ответов внутри одной игры и по всему корпусу; точный оценщик должен
+    давать те же баллы;
+  * замеряет время одиночного вызова по группам длины и пакетной оценки всего корпуса
+    для _calculate_similarity, get_similarity_score и профиля, а также пик памяти (tracemalloc).
+
+Запуск: python -m benchmarks.similarity_bench
+Проверка точности без замеров (для CI): python -m benchmarks.similarity_bench --check
+Пересчитать ожидаемые баллы после осознанного изменения оценки: --record
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from config.config import SIMILARITY_MEMO_SIZE
+from utils.similarity import _calculate_similarity, get_similarity_score, build_reference_profile, ReferenceProfile
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'similarity_corpus.json')
+
+# Минимальный tau Кендалла для оценщика, который должен сохранять порядок ответов точно
+EXACT_TAU = 1.0
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)['pairs']
+
+
+def kendall_tau(xs, ys):
+    """tau-b Кендалла: 1 — порядок совпадает, -1 — обратный. Учитывает равные значения."""
+    concordant = discordant = ties_x = ties_y = 0
+    for i in range(len(xs)):
+        for j in range(i + 1, len(xs)):
+            dx = xs[i] - xs[j]
+            dy = ys[i] - ys[j]
+            if dx == 0 and dy == 0:
+                continue
+            if dx == 0:
+                ties_x += 1
+            elif dy == 0:
+                ties_y += 1
+            elif (dx > 0) == (dy > 0):
+                concordant += 1
+            else:
+                discordant += 1
+    denominator = math.sqrt((concordant + discordant + ties_x) * (concordant + discordant + ties_y))
+    return (concordant - discordant) / denominator if denominator else 1.0
+
+
+def current_scores(pairs):
+    return [_calculate_similarity(pair['submission'], pair['reference']) for pair in pairs]
+
+
+def profile_scorer(pairs):
+    profiles = {}
+    scores = []
+    for pair in pairs:
+        profile = profiles.get(pair['reference'])
+        if profile is None:
+            profile = profiles[pair['reference']] = build_reference_profile(pair['reference'])
+        scores.append(profile.score(pair['submission']))
+    return scores
+
+
+# Альтернативные оценщики: имя -> (функция над корпусом, должен ли балл совпадать точно)
+CANDIDATES = {
+    'profile': (profile_scorer, True),
+}
+
+
+def ranking_report(pairs, reference_scores, candidate_scores):
+    """Общий tau, средний и минимальный tau внутри групп (одна группа — ответы на один эталон)."""
+    groups = defaultdict(list)
+    for index, pair in enumerate(pairs):
+        groups[pair['group']].append(index)
+    per_group = [
+        kendall_tau([reference_scores[i] for i in indexes], [candidate_scores[i] for i in indexes])
+        for indexes in groups.values()
+    ]
+    return {
+        'tau': kendall_tau(reference_scores, candidate_scores),
+        'group_tau_mean': sum(per_group) / len(per_group),
+        'group_tau_min': min(per_group),
+        'max_abs_diff': max(abs(a - b) for a, b in zip(reference_scores, candidate_scores)),
+    }
+
+
+def check_accuracy(pairs, min_tau):
+    """Печатает отчет о точности и возвращает список проблем."""
+    problems = []
+    scores = current_scores(pairs)
+    for pair, score in zip(pairs, scores):
+        if score != pair['expected']:
+            problems.append(f"_calculate_similarity: {score} вместо {pair['expected']} "
+                            f"для «{pair['submission']}» / «{pair['reference']}»")
+
+    print(f"{'оценщик':12s} {'tau':>6s} {'tau в группе (ср.)':>19s} {'(мин.)':>7s} {'макс. расхождение':>18s}")
+    for name, (scorer, exact) in CANDIDATES.items():
+        report = ranking_report(pairs, scores, scorer(pairs))
+        print(f"{name:12s} {report['tau']:6.3f} {report['group_tau_mean']:19.3f} {report['group_tau_min']:7.3f} "
+              f"{report['max_abs_diff']:18d}")
+        threshold = EXACT_TAU if exact else min_tau
+        if report['group_tau_min'] < threshold:
+            problems.append(f"{name}: tau внутри группы {report['group_tau_min']:.3f} < {threshold}")
+        if exact and report['max_abs_diff']:
+            problems.append(f"{name}: баллы расходятся с _calculate_similarity до {report['max_abs_diff']}")
+    return problems
+
+
+def _timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat
+
+
+def _peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(pairs, repeat):
+    # Одиночный вызов по группам длины эталона
+    by_length = defaultdict(list)
+    for pair in pairs:
+        length = len(pair['reference'])
+        bucket = 'короткие' if length < 40 else 'средние' if length < 120 else 'длинные'
+        by_length[bucket].append(pair)
+
+    print(f"\nОдиночный вызов, мкс (среднее по {repeat} повторам каждой пары)")
+    print(f"{'эталоны':10s} {'пар':>4s} {'_calculate_similarity':>22s} {'get_similarity_score':>21s} {'профиль':>9s}")
+    for bucket in ('короткие', 'средние', 'длинные'):
+        group = by_length.get(bucket)
+        if not group:
+            continue
+        calc = sum(_timed(lambda: _calculate_similarity(p['submission'], p['reference']), repeat)
+                   for p in group) / len(group)
+
+        async def single_async():
+            total = 0.0
+            for p in group:
+                started = time.perf_counter()
+                for _ in range(repeat):
+                    await get_similarity_score(p['submission'], p['reference'])
+                total += (time.perf_counter() - started) / repeat
+            return total / len(group)
+        async_single = asyncio.run(single_async())
+
+        profiles = {p['reference']: build_reference_profile(p['reference']) for p in group}
+        # Кеш повторов сбрасывается перед каждым вызовом, чтобы замерять сам подсчет
+        def profile_call(p):
+            profile = profiles[p['reference']]
+            profile._memo.clear()
+            profile.score(p['submission'])
+        prof = sum(_timed(lambda: profile_call(p), repeat) for p in group) / len(group)
+        print(f"{bucket:10s} {len(group):4d} {calc * 1e6:22.1f} {async_single * 1e6:21.1f} {prof * 1e6:9.1f}")
+
+    # Пакет: весь корпус, повторенный так, чтобы вышло не меньше 1000 оценок.
+    # Большая часть пакета — повторы одних и тех же пар, поэтому профиль замеряется и с кешем, и без него
+    batch = pairs * -(-1000 // len(pairs))
+    repeats = len(batch) - len({(p['reference'], p['submission']) for p in batch})
+    print(f"\nПакет из {len(batch)} оценок, из них повторов {repeats} ({100 * repeats / len(batch):.0f}%)")
+    print(f"{'способ':40s} {'время, мс':>10s} {'оценок/с':>10s} {'пик памяти, КБ':>15s}")
+
+    def run_calc():
+        for p in batch:
+            _calculate_similarity(p['submission'], p['reference'])
+
+    async def gather_async():
+        await asyncio.gather(*(get_similarity_score(p['submission'], p['reference']) for p in batch))
+
+    def run_profile(memo_size=SIMILARITY_MEMO_SIZE):
+        profiles = {}
+        for p in batch:
+            profile = profiles.get(p['reference'])
+            if profile is None:
+                profile = profiles[p['reference']] = ReferenceProfile(p['reference'], memo_size=memo_size)
+            profile.score(p['submission'])
+
+    variants = [
+        ('_calculate_similarity в цикле', run_calc),
+        ('get_similarity_score, asyncio.gather', lambda: asyncio.run(gather_async())),
+        ('профиль эталона (с кешем повторов)', run_profile),
+        # Каждый ответ считается заново, как в игре, где ответы не повторяются
+        ('профиль эталона (без кеша повторов)', lambda: run_profile(memo_size=0)),
+    ]
+    for name, func in variants:
+        elapsed = _timed(func, 1)
+        peak = _peak_memory(func)
+        print(f"{name:40s} {elapsed * 1000:10.1f} {len(batch) / elapsed:10.0f} {peak / 1024:15.1f}")
+
+
+def record(pairs, path):
+    for pair, score in zip(pairs, current_scores(pairs)):
+        pair['expected'] = score
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'pairs': pairs}, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+    print(f"Ожидаемые баллы записаны в {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=CORPUS_PATH)
+    parser.add_argument('--repeat', type=int, default=200, help="повторов одиночного вызова на пару")
+    parser.add_argument('--min-tau', type=float, default=0.5,
+                        help="минимальный tau внутри группы для приближенных оценщиков")
+    parser.add_argument('--check', action='store_true', help="только проверка точности")
+    parser.add_argument('--record', action='store_true', help="пересчитать ожидаемые баллы корпуса")
+    args = parser.parse_args()
+
+    pairs = load_corpus(args.corpus)
+    if args.record:
+        record(pairs, args.corpus)
+        return
+    print(f"Корпус: {len(pairs)} пар, {len({p['reference'] for p in pairs})} эталонов\n")
+    problems = check_accuracy(pairs, args.min_tau)
+    if not args.check:
+        benchmark(pairs, args.repeat)
+    for problem in problems:
+        print(f"ОШИБКА: {problem}")
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Время холодного запуска бота до первого обработанного обновления.
+
+Бот запускается отдельным процессом (python app.py) в режиме long polling на поддельном Bot API
+(benchmarks/fake_telegram.py) с новой временной базой. Обновление /start кладется в очередь
+заранее, поэтому замеряется время от запуска процесса до:
+  * первого getUpdates — бот готов получать обновления;
+  * первого sendMessage — ответ на первое обновление (time-to-first-update).
+Из лога бота берется разбивка on_startup по фазам (строка «Запуск за ...»).
+
+Запуск: python -m benchmarks.startup_bench --runs 5
+Результат сравнивается с базовым прогоном benchmarks/baselines/startup.json (--save-baseline — обновить).
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from benchmarks.fake_telegram import FakeTelegram, message_update
+from benchmarks.webhook_vs_polling import TOKEN, ROOT, bot_env, stop_bot
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'startup.json')
+STARTUP_LOG_MARKER = 'Запуск за'
+
+
+def first_call(fake, method):
+    return next(at for name, _, at in fake.calls if name == method)
+
+
+async def run_once(args):
+    fake = FakeTelegram(TOKEN, latency=args.latency)
+    api_url = await fake.start()
+    fake.push_updates([message_update(1, 1_000_000, '/start')])
+    log_lines = []
+
+    async def read_log(stream):
+        async for line in stream:
+            log_lines.append(line.decode(errors='replace').rstrip())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = bot_env(api_url, os.path.join(tmp, 'startup.db'), BOT_MODE='polling',
+                      ADMIN_IDS=','.join(str(i) for i in range(1, args.admins + 1)),
+                      SCORER_BACKEND=args.scorer_backend, EXPORT_CACHE_DIR=os.path.join(tmp, 'exports'))
+        started = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(ROOT, 'app.py'), cwd=ROOT, env=env,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        reader = asyncio.create_task(read_log(process.stderr))
+        try:
+            await fake.wait_for('sendMessage', 1, timeout=120)
+            result = {
+                'ready_s': first_call(fake, 'getUpdates') - started,
+                'first_update_s': first_call(fake, 'sendMessage') - started,
+            }
+        finally:
+            await stop_bot(process)
+            await reader
+            await fake.stop()
+
+    result['startup_log'] = next((line.split(' - ')[-1] for line in log_lines if STARTUP_LOG_MARKER in line), '')
+    return result
+
+
+def summarize(runs, args):
+    return {
+        'params': {'latency': args.latency, 'admins': args.admins, 'scorer_backend': args.scorer_backend},
+        'runs': len(runs),
+        'ready_s': round(statistics.median(run['ready_s'] for run in runs), 3),
+        'first_update_s': round(statistics.median(run['first_update_s'] for run in runs), 3),
+        'first_update_max_s': round(max(run['first_update_s'] for run in runs), 3),
+    }
+
+
+def compare(summary, baseline, tolerance):
+    """Возвращает список регрессий относительно базового прогона."""
+    if baseline['params'] != summary['params']:
+        print("Параметры прогона отличаются от базового, сравнение пропущено")
+        return []
+    problems = []
+    for key in ('ready_s', 'first_update_s'):
+        if summary[key] > baseline[key] * (1 + tolerance):
+            problems.append(f"{key} {summary[key]} > {baseline[key]} с")
+    return problems
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.05, help="задержка ответа Bot API, с")
+    parser.add_argument('--admins', type=int, default=3, help="сколько администраторам регистрировать команды")
+    parser.add_argument('--scorer-backend', default='thread')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    runs = []
+    for index in range(args.runs):
+        run = await run_once(args)
+        runs.append(run)
+        print(f"прогон {index + 1}: готов к обновлениям {run['ready_s'] * 1000:7.0f} мс, "
+              f"первый ответ {run['first_update_s'] * 1000:7.0f} мс")
+    print(f"on_startup последнего прогона: {runs[-1]['startup_log'] or 'нет строки в логе'}")
+
+    summary = summarize(runs, args)
+    print(f"Медиана: готов за {summary['ready_s'] * 1000:.0f} мс, "
+          f"первый ответ за {summary['first_update_s'] * 1000:.0f} мс (худший {summary['first_update_max_s'] * 1000:.0f} мс)")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"Базовый прогон сохранен в {args.baseline}")
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            problems = compare(summary, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"РЕГРЕССИЯ: {problem}")
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
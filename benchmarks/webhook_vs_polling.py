@@ -0,0 +1,130 @@
+"""
+Сравнение пропускной способности long polling и вебхука на поддельном Bot API.
+
+Бот запускается отдельным процессом (python app.py) с TELEGRAM_API_URL, указывающим на локальный
+FakeTelegram, и временной базой. N новых пользователей присылают /start; замеряется время,
+за которое бот отправил все ответы.
+
+Запуск: python -m benchmarks.webhook_vs_polling --users 500
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import time
+import aiohttp
+from benchmarks.fake_telegram import FakeTelegram, message_update
+
+TOKEN = '123456:FAKE-TOKEN-FOR-BENCHMARKS'
+SECRET = 'benchmark-secret'
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bot_env(api_url, db_path, **extra):
+    env = dict(os.environ)
+    env.update({
+        'BOT_TOKEN': TOKEN,
+        'TELEGRAM_API_URL': api_url,
+        'DB_PATH': db_path,
+        'ADMIN_IDS': '',
+        'CHANNEL_ID': '-1000000000000',
+    })
+    env.update(extra)
+    return env
+
+
+async def wait_port(port, timeout=30.0):
+    # on_startup бота выполняется до того, как HTTP-сервер начинает принимать соединения
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        await writer.wait_closed()
+        return
+
+
+async def start_bot(env):
+    return await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(ROOT, 'app.py'), cwd=ROOT, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+
+
+async def stop_bot(process):
+    if process.returncode is None:
+        process.terminate()
+        await process.wait()
+
+
+async def post_updates(url, updates, concurrency=32):
+    queue = iter(updates)
+    async with aiohttp.ClientSession() as session:
+        async def worker():
+            for update in queue:
+                async with session.post(url, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': SECRET}) as resp:
+                    resp.raise_for_status()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def run_mode(mode, users, latency):
+    fake = FakeTelegram(TOKEN, latency=latency)
+    api_url = await fake.start()
+    updates = [message_update(i + 1, 1_000_000 + i, '/start') for i in range(users)]
+    # На /start новый пользователь получает приветствие и просьбу поделиться номером
+    expected = users * 2
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        if mode == 'webhook':
+            port = free_port()
+            env = bot_env(api_url, db_path, BOT_MODE='webhook', WEBHOOK_HOST='127.0.0.1',
+                          WEBHOOK_PORT=str(port), WEBHOOK_SECRET=SECRET)
+        else:
+            env = bot_env(api_url, db_path, BOT_MODE='polling')
+        process = await start_bot(env)
+        try:
+            # Команды регистрируются в фоне сразу после подъема БД; вебхук дополнительно ждем по порту
+            await fake.wait_for('setMyCommands', 1, timeout=60)
+            if mode == 'webhook':
+                await wait_port(port)
+            started = time.perf_counter()
+            if mode == 'webhook':
+                await post_updates(f'http://127.0.0.1:{port}/webhook', updates)
+            else:
+                fake.push_updates(updates)
+            await fake.wait_for('sendMessage', expected, timeout=600)
+            elapsed = time.perf_counter() - started
+        finally:
+            await stop_bot(process)
+            await fake.stop()
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument('--modes', default='polling,webhook')
+    args = parser.parse_args()
+
+    for mode in args.modes.split(','):
+        elapsed = await run_mode(mode, args.users, args.latency)
+        print(f"{mode:8s}: {args.users} обновлений за {elapsed:.2f} с, {args.users / elapsed:.0f} обновлений/с")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -19,3 +19,123 @@ try:
     CHANNEL_ID = int(raw_channel_id)
 except (ValueError, TypeError):
     CHANNEL_ID = raw_channel_id
+
+# Настройки базы данных
+DB_PATH = os.getenv("DB_PATH", "prompt_battle.db")
+# Количество постоянных соединений в пуле
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+# Сколько миллисекунд SQLite ждет освобождения блокировки, прежде чем вернуть "database is locked"
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# Групповая запись: пачка фиксируется каждые DB_WRITE_FLUSH_MS мс или по DB_WRITE_BATCH_SIZE выражений
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "200"))
+DB_WRITE_FLUSH_MS = int(os.getenv("DB_WRITE_FLUSH_MS", "20"))
+# Максимальная длина очереди записей; при переполнении хендлеры ждут освобождения места
+DB_WRITE_QUEUE_SIZE = int(os.getenv("DB_WRITE_QUEUE_SIZE", "10000"))
+# Сколько раз повторять пачку, которую не удалось зафиксировать (например, "database is locked"),
+# и начальная пауза между повторами (мс, удваивается с каждой попыткой)
+DB_WRITE_RETRIES = int(os.getenv("DB_WRITE_RETRIES", "5"))
+DB_WRITE_RETRY_DELAY_MS = int(os.getenv("DB_WRITE_RETRY_DELAY_MS", "100"))
+
+# Настройки рассылок
+# Глобальный лимит Telegram — около 30 сообщений в секунду
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "30"))
+# Минимальный интервал между сообщениями в один чат (секунды)
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1.0"))
+# Сколько сообщений отправляется одновременно
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))
+# Сколько раз повторять отправку при сетевых ошибках и flood control
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+# Как часто обновлять сообщение с прогрессом рассылки у администратора (секунды)
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "3"))
+# Сколько получателей рассылки забирать из очереди в БД за раз; исход пачки фиксируется одной транзакцией
+BROADCAST_CLAIM_BATCH = int(os.getenv("BROADCAST_CLAIM_BATCH", "100"))
+# После скольких постоянных ошибок доставки подряд (например, «chat not found») пользователь исключается
+# из рассылок (заблокировавший бота — сразу). Временные сбои Telegram не учитываются.
+# Написав боту, пользователь снова получает рассылки
+USER_MAX_FAILURES = int(os.getenv("USER_MAX_FAILURES", "3"))
+# Как часто каждый процесс перечитывает из БД список исключенных из рассылок пользователей (секунды).
+# По нему без запроса к БД решается, нужно ли вернуть написавшего боту пользователя в рассылки
+UNREACHABLE_REFRESH_INTERVAL = float(os.getenv("UNREACHABLE_REFRESH_INTERVAL", "60"))
+
+# Кеш проверки подписки на канал
+# Сколько секунд помнить, что пользователь подписан / не подписан
+SUBSCRIPTION_POSITIVE_TTL = float(os.getenv("SUBSCRIPTION_POSITIVE_TTL", "300"))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", "30"))
+# Максимальное число пользователей в кеше
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "100000"))
+
+# Сколько оценок одинаковых ответов помнить для каждой игры
+SIMILARITY_MEMO_SIZE = int(os.getenv("SIMILARITY_MEMO_SIZE", "4096"))
+# Где считать оценку ответов: inline (в цикле событий), thread (в потоке) или process (в пуле процессов)
+SCORER_BACKEND = os.getenv("SCORER_BACKEND", "thread")
+# Число одновременных оценок (для бэкенда process — число процессов); 0 — по числу ядер.
+# При запуске через supervisor.py — на все воркеры вместе
+SCORER_WORKERS = int(os.getenv("SCORER_WORKERS", "0"))
+# Сколько секунд ждать выполнения точной оценки; не уложившийся ответ оценивается при остановке игры
+SCORER_TIMEOUT = float(os.getenv("SCORER_TIMEOUT", "2.0"))
+# Когда оценивать ответы: inline — сразу при отправке, deferred — пачкой при остановке игры
+SCORING_MODE = os.getenv("SCORING_MODE", "inline")
+
+# Каталог для кеша выгрузок результатов завершенных игр
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", "exports")
+# Сколько строк читать из БД за один раз при выгрузке
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+# Хранилище состояний FSM
+# Через сколько секунд без изменений состояние пользователя считается устаревшим (0 — никогда)
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", "86400"))
+# Сколько состояний держать в памяти
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "50000"))
+# Как часто удалять устаревшие состояния (секунды)
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", "600"))
+
+# Режим получения обновлений: polling (long polling) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Адрес сервера Bot API, если используется не api.telegram.org (например, локальный сервер)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
+# Настройки вебхука
+# Публичный адрес, на который Telegram будет присылать обновления (без пути). Пусто — вебхук не регистрируется
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секретный токен, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token.
+# Пусто — случайный токен при регистрации вебхука (без WEBHOOK_URL бот в режиме webhook не запустится)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Сколько обновлений обрабатывается одновременно и сколько может ждать в очереди
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "64"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "10000"))
+
+# Ограничение частоты запросов пользователей (token bucket на пользователя)
+# Игровые действия: сколько запросов в секунду восстанавливается и сколько можно сделать подряд
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", "5"))
+# Произвольный текст вне игры: лимит строже
+THROTTLE_TEXT_RATE = float(os.getenv("THROTTLE_TEXT_RATE", "0.2"))
+THROTTLE_TEXT_BURST = int(os.getenv("THROTTLE_TEXT_BURST", "2"))
+# Сколько корзин пользователей держать в памяти
+THROTTLE_CACHE_SIZE = int(os.getenv("THROTTLE_CACHE_SIZE", "100000"))
+
+# Метрики в формате Prometheus: адрес и порт HTTP-сервера /metrics (0 — не запускать).
+# При запуске через supervisor.py воркер N слушает порт METRICS_PORT + N
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Как часто замерять запаздывание цикла событий (секунды)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+# Запуск в нескольких процессах (supervisor.py)
+# Число процессов-воркеров; 0 — по числу ядер
+WORKERS = int(os.getenv("WORKERS", "0"))
+# Сколько обновлений воркер обрабатывает одновременно
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "64"))
+# Сколько обновлений может ждать в очереди каждого воркера
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "10000"))
+# Как часто воркеры сообщают о своем состоянии (секунды)
+WORKER_HEALTH_INTERVAL = float(os.getenv("WORKER_HEALTH_INTERVAL", "10"))
+
+# Фоновые задачи администратора (остановка, запуск и продолжение игры)
+# Как часто обновлять сообщение со статусом задачи (секунды)
+JOB_STATUS_INTERVAL = float(os.getenv("JOB_STATUS_INTERVAL", "3"))
+# Сколько завершенных задач показывать в /jobs
+JOB_HISTORY_SIZE = int(os.getenv("JOB_HISTORY_SIZE", "20"))
@@ -0,0 +1,66 @@
+from db.database import get_active_game_record
+from utils.similarity import build_reference_profile
+
+
+class ActiveGame:
+    __slots__ = ('game_id', 'prompt', 'photo_id', 'profile')
+
+    def __init__(self, game_id, prompt, photo_id):
+        self.game_id = game_id
+        self.prompt = prompt
+        self.photo_id = photo_id
+        # Эталон для оценки ответов готовится один раз при активации игры
+        self.profile = build_reference_profile(prompt or '')
+
+
+class ActiveGameCache:
+    """
+    Запись активной игры в памяти процесса.
+
+    Активная игра меняется только командами администратора (старт, остановка, продолжение),
+    поэтому пользовательские хендлеры читают ее отсюда без обращения к БД.
+    Кеш заполняется при старте бота, а пути администратора заменяют запись целиком
+    одним присваиванием, так что читатель видит либо старую игру, либо новую.
+
+    Подписчики (subscribe) узнают о каждой смене игры: так при запуске в нескольких
+    процессах воркер администратора сообщает остальным, что кеш нужно перечитать.
+    """
+
+    def __init__(self):
+        self._game = None
+        self._listeners = []
+
+    def get(self):
+        return self._game
+
+    @property
+    def game_id(self):
+        game = self._game
+        return game.game_id if game else None
+
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+
+    def notify(self):
+        for callback in self._listeners:
+            callback()
+
+    async def reload(self, notify=True):
+        row = await get_active_game_record()
+        self._game = ActiveGame(row['game_id'], row['prompt'], row['photo_id']) if row else None
+        if notify:
+            self.notify()
+        return self._game
+
+    def clear(self, notify=True):
+        """
+        Убирает активную игру. С notify=False меняется только кеш этого процесса:
+        так игра снимается до записи в БД, а остальные процессы оповещаются (notify)
+        уже после нее, иначе они перечитали бы из БД еще активную игру.
+        """
+        self._game = None
+        if notify:
+            self.notify()
+
+
+active_game = ActiveGameCache()
@@ -0,0 +1,147 @@
+"""
+Проверка планов запросов: каждая функция db.database выполняется на временной базе,
+все выполненные ею SQL-запросы перехватываются и прогоняются через EXPLAIN QUERY PLAN.
+Если какой-то запрос читает таблицу целиком (SCAN без индекса), проверка завершается с ошибкой.
+
+Запуск: python -m db.check_query_plans
+"""
+import asyncio
+import inspect
+import os
+import re
+import sys
+import tempfile
+
+from db import database
+
+# Функции жизненного цикла и статистики не обращаются к таблицам
+SKIP = {'open_db', 'close_db', 'init_db'}
+
+# Запросы, которым полный проход по таблице нужен по смыслу: имя функции -> таблицы.
+# Сейчас таких нет: рассылка выбирает получателей по индексу idx_users_reachable
+ALLOWED_SCANS = {}
+
+# Тестовые значения аргументов по имени параметра
+SAMPLE_ARGS = {
+    'user_id': 1,
+    'username': 'player',
+    'first_name': 'Имя',
+    'last_name': 'Фамилия',
+    'phone_number': '+70000000000',
+    'state': 'registered',
+    'prompt': 'a cat in a hat',
+    'prompt_text': 'cat with a hat',
+    'photo_id': 'photo',
+    'score': 50,
+    'max_attempts': 1,
+    'scores': [(1, 50)],
+    'best': True,
+    'key': 'start:game',
+    'title': 'Рассылка',
+    'text': 'Новый раунд',
+    'recipients': [(1, None), (2, 'Персональный текст')],
+    'broadcast_id': 1,
+    'limit': 100,
+    'outcomes': [(1, 'sent', None, False)],
+}
+
+CHECKED_PREFIXES = ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')
+SCAN_RE = re.compile(r'^SCAN (\w+)(.*)$')
+
+
+def _is_async_function(obj):
+    return inspect.iscoroutinefunction(obj) or inspect.isasyncgenfunction(obj)
+
+
+async def _table_names(db):
+    cursor = await db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return {row[0] for row in await cursor.fetchall()}
+
+
+async def _seed():
+    await database.add_or_update_user(1, 'player', 'Имя', 'Фамилия', wait=True)
+    game_id = await database.add_game('a cat in a hat', 'photo')
+    await database.add_game('a dog in a hat', 'photo')
+    await database.start_next_game()
+    await database.add_participant(game_id, 1, wait=True)
+    await database.add_result(game_id, 1, 'player', 'cat', 50, wait=True)
+    await database.create_broadcast('seed', 'Рассылка', 'Текст', [(1, None)])
+    return game_id
+
+
+def _call_args(func, game_id):
+    args = {}
+    for name, param in inspect.signature(func).parameters.items():
+        if name == 'game_id':
+            args[name] = game_id
+        elif name == 'wait':
+            # Дожидаемся фиксации, чтобы запросы писателя попали в трассировку этой функции
+            args[name] = True
+        elif name in SAMPLE_ARGS:
+            args[name] = SAMPLE_ARGS[name]
+        elif param.default is inspect.Parameter.empty:
+            raise ValueError(f"Нет тестового значения для параметра {name} функции {func.__name__}")
+    return args
+
+
+async def _full_scans(db, sql, tables):
+    cursor = await db.execute(f'EXPLAIN QUERY PLAN {sql}')
+    scans = set()
+    for row in await cursor.fetchall():
+        match = SCAN_RE.match(row['detail'])
+        # Проход по покрывающему индексу без условия тоже считается полным чтением таблицы
+        if match and match.group(1) in tables:
+            scans.add(match.group(1))
+    return scans
+
+
+async def check_query_plans():
+    """Возвращает список найденных проблем: (функция, таблица, запрос)."""
+    problems = []
+    functions = [
+        (name, func) for name, func in inspect.getmembers(database, _is_async_function)
+        if func.__module__ == database.__name__ and not name.startswith('_') and name not in SKIP
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        await database.open_db(os.path.join(tmp, 'plans.db'))
+        try:
+            await database.init_db()
+            game_id = await _seed()
+            captured = []
+            await database.pool.set_trace_callback(captured.append)
+            traced = []
+            for name, func in functions:
+                captured.clear()
+                result = func(**_call_args(func, game_id))
+                if inspect.isasyncgen(result):
+                    async for _ in result:
+                        pass
+                else:
+                    await result
+                traced.append((name, [sql for sql in captured if sql.lstrip().upper().startswith(CHECKED_PREFIXES)]))
+            await database.pool.set_trace_callback(None)
+
+            async with database.pool.acquire() as db:
+                tables = await _table_names(db)
+                for name, statements in traced:
+                    for sql in statements:
+                        for table in await _full_scans(db, sql, tables):
+                            if table not in ALLOWED_SCANS.get(name, ()):
+                                problems.append((name, table, ' '.join(sql.split())))
+        finally:
+            await database.close_db()
+    return problems
+
+
+def main():
+    problems = asyncio.run(check_query_plans())
+    for name, table, sql in problems:
+        print(f"{name}: полный проход по таблице {table}\n    {sql}")
+    if problems:
+        sys.exit(1)
+    print("Все запросы используют индексы.")
+
+
+if __name__ == '__main__':
+    main()
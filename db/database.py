@@ -1,58 +1,48 @@
-import aiosqlite
+import time
 import uuid
 from datetime import datetime
+from config.config import (DB_PATH, DB_POOL_SIZE, DB_BUSY_TIMEOUT_MS, DB_WRITE_BATCH_SIZE, DB_WRITE_FLUSH_MS,
+                           DB_WRITE_QUEUE_SIZE, DB_WRITE_RETRIES, DB_WRITE_RETRY_DELAY_MS, USER_MAX_FAILURES)
+from db.migrations import BEST_SCORES_FILL, apply_migrations
+from db.pool import ConnectionPool
+from db.writer import WriteBehindQueue
+from utils.metrics import DB_SECONDS, DB_ERRORS, Gauge, instrument_module
+
+# Общий пул соединений. Открывается в on_startup и закрывается в on_shutdown.
+pool = ConnectionPool(DB_PATH, size=DB_POOL_SIZE, busy_timeout_ms=DB_BUSY_TIMEOUT_MS)
+# Единственный писатель: частые записи из хендлеров фиксируются пачками
+writer = WriteBehindQueue(pool, batch_size=DB_WRITE_BATCH_SIZE, flush_ms=DB_WRITE_FLUSH_MS,
+                          max_queue=DB_WRITE_QUEUE_SIZE, retries=DB_WRITE_RETRIES,
+                          retry_delay_ms=DB_WRITE_RETRY_DELAY_MS)
+
+Gauge('db_pool_in_use', "Занятые соединения пула", callback=lambda: pool.snapshot()['in_use'])
+Gauge('db_pool_waited', "Сколько раз запрос ждал свободное соединение", callback=lambda: pool.stats.waited)
+Gauge('db_writer_queue_depth', "Записи в очереди группового писателя", callback=lambda: writer.depth)
+
+async def open_db(path=None):
+    if path is not None:
+        pool.path = path
+    await pool.open()
+    writer.start()
+
+async def close_db():
+    # Сначала дописываем очередь, затем закрываем соединения
+    await writer.stop()
+    await pool.close()
+
+def get_pool_stats():
+    return pool.snapshot()
+
+def get_writer_stats():
+    return writer.snapshot()
 
 async def init_db():
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        # Таблица для пользователей
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                phone_number TEXT,
-                state TEXT DEFAULT 'new'
-            )
-        ''')
-        # Таблица для игр
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS games (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                game_id TEXT UNIQUE,
-                prompt TEXT,
-                photo_id TEXT,
-                status TEXT DEFAULT 'pending' 
-            )
-        ''')
-        # Таблица для результатов
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS results (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                game_id TEXT,
-                user_id INTEGER,
-                username TEXT,
-                prompt_text TEXT,
-                score INTEGER,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (game_id) REFERENCES games (game_id)
-            )
-        ''')
-        # Новая таблица для участников
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS participants (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                game_id TEXT,
-                user_id INTEGER,
-                UNIQUE(game_id, user_id),
-                FOREIGN KEY (game_id) REFERENCES games (game_id)
-            )
-        ''')
-        await db.commit()
+    async with pool.acquire() as db:
+        await apply_migrations(db)
 
 async def add_game(prompt, photo_id):
     game_id = str(uuid.uuid4())
-    async with aiosqlite.connect('prompt_battle.db') as db:
+    async with pool.acquire() as db:
         await db.execute(
             "INSERT INTO games (game_id, prompt, photo_id, status) VALUES (?, ?, ?, 'pending')",
             (game_id, prompt, photo_id)
@@ -61,9 +51,15 @@ async def add_game(prompt, photo_id):
     return game_id
 
 
+async def has_pending_games():
+    async with pool.acquire() as db:
+        cursor = await db.execute("SELECT 1 FROM games WHERE status = 'pending' LIMIT 1")
+        return await cursor.fetchone() is not None
+
 async def start_next_game():
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        # Завершаем текущую активную игру, если она есть
+    async with pool.acquire() as db:
+        # Завершаем текущую активную игру, если она есть. Это страховка: start_game_logic
+        # сначала останавливает ее через stop_game_logic, чтобы ответы были оценены, а итоги разосланы
         await db.execute("UPDATE games SET status = 'finished' WHERE status = 'active'")
         
         # Находим следующую ожидающую игру
@@ -81,39 +77,42 @@ async def start_next_game():
         return None
 
 async def stop_game(game_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
+    async with pool.acquire() as db:
         await db.execute("UPDATE games SET status = 'finished' WHERE game_id = ?", (game_id,))
         await db.commit()
 
 async def get_game(game_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
+    async with pool.acquire() as db:
         cursor = await db.execute('SELECT prompt, photo_id FROM games WHERE game_id = ?', (game_id,))
         return await cursor.fetchone()
 
 async def get_game_status(game_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
+    async with pool.acquire() as db:
         cursor = await db.execute('SELECT status FROM games WHERE game_id = ?', (game_id,))
         row = await cursor.fetchone()
         return row[0] if row else None
 
 async def get_game_prompt(game_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
+    async with pool.acquire() as db:
         cursor = await db.execute("SELECT prompt FROM games WHERE game_id = ? AND status = 'active'", (game_id,))
         row = await cursor.fetchone()
         return row[0] if row else None
 
-async def add_participant(game_id, user_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        await db.execute("INSERT OR IGNORE INTO participants (game_id, user_id) VALUES (?, ?)", (game_id, user_id))
-        await db.commit()
+async def add_participant(game_id, user_id, wait=False):
+    return await writer.submit(
+        [("INSERT OR IGNORE INTO participants (game_id, user_id) VALUES (?, ?)", (game_id, user_id))],
+        wait=wait
+    )
 
 async def get_participants(game_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
+    # Итоги рассылаются и тем, чей ответ еще стоит в очереди писателя
+    await writer.flush()
+    async with pool.acquire() as db:
         cursor = await db.execute("SELECT user_id FROM participants WHERE game_id = ?", (game_id,))
         return [row[0] for row in await cursor.fetchall()]
 
 async def get_user_active_game(user_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
+    async with pool.acquire() as db:
         cursor = await db.execute("""
             SELECT p.game_id FROM participants p
             JOIN games g ON p.game_id = g.game_id
@@ -122,10 +121,10 @@ async def get_user_active_game(user_id):
         row = await cursor.fetchone()
         return row[0] if row else None
 
-async def add_or_update_user(user_id, username, first_name, last_name):
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        # При первом запуске/перезапуске бота, если юзер уже есть, не меняем его состояние
-        await db.execute(
+async def add_or_update_user(user_id, username, first_name, last_name, wait=False):
+    # При первом запуске/перезапуске бота, если юзер уже есть, не меняем его состояние
+    return await writer.submit(
+        [(
             '''
             INSERT INTO users (user_id, username, first_name, last_name, state) 
             VALUES (?, ?, ?, ?, 'new')
@@ -135,97 +134,264 @@ async def add_or_update_user(user_id, username, first_name, last_name):
             last_name=excluded.last_name
             ''',
             (user_id, username, first_name, last_name)
-        )
-        await db.commit()
+        )],
+        wait=wait
+    )
 
 async def get_user_by_id(user_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        db.row_factory = aiosqlite.Row
+    async with pool.acquire() as db:
         cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
         return await cursor.fetchone()
 
-async def update_user_state(user_id, state):
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        await db.execute("UPDATE users SET state = ? WHERE user_id = ?", (state, user_id))
-        await db.commit()
+async def get_user_session(user_id, game_id=None):
+    """
+    Все, что нужно хендлеру пользователя, одним запросом: данные пользователя
+    и его участие в игре game_id (attempts = NULL, если он в ней не участвует).
+    """
+    async with pool.acquire() as db:
+        cursor = await db.execute('''
+            SELECT u.user_id, u.username, u.phone_number, u.state, u.reachable, p.attempts
+            FROM users u
+            LEFT JOIN participants p ON p.game_id = ? AND p.user_id = u.user_id
+            WHERE u.user_id = ?
+        ''', (game_id, user_id))
+        return await cursor.fetchone()
 
-async def update_user_phone(user_id, phone_number):
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        await db.execute("UPDATE users SET phone_number = ? WHERE user_id = ?", (phone_number, user_id))
-        await db.commit()
+async def update_user_state(user_id, state, wait=False):
+    return await writer.submit(
+        [("UPDATE users SET state = ? WHERE user_id = ?", (state, user_id))],
+        wait=wait
+    )
+
+async def update_user_phone(user_id, phone_number, wait=False):
+    return await writer.submit(
+        [("UPDATE users SET phone_number = ? WHERE user_id = ?", (phone_number, user_id))],
+        wait=wait
+    )
 
-async def get_all_user_ids():
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        cursor = await db.execute("SELECT user_id FROM users")
+async def get_reachable_user_ids():
+    """Получатели рассылки: пользователи, которые не заблокировали бота и не копят ошибки доставки."""
+    await writer.flush()
+    async with pool.acquire() as db:
+        cursor = await db.execute("SELECT user_id FROM users WHERE reachable = 1")
         return [row[0] for row in await cursor.fetchall()]
 
-async def add_result(game_id, user_id, username, prompt_text, score):
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        await db.execute(
-            'INSERT INTO results (game_id, user_id, username, prompt_text, score, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
+async def get_unreachable_user_count():
+    async with pool.acquire() as db:
+        cursor = await db.execute("SELECT COUNT(*) FROM users WHERE reachable = 0")
+        return (await cursor.fetchone())[0]
+
+async def get_unreachable_user_ids():
+    async with pool.acquire() as db:
+        cursor = await db.execute("SELECT user_id FROM users WHERE reachable = 0")
+        return [row[0] for row in await cursor.fetchall()]
+
+async def reactivate_user(user_id, wait=False):
+    """
+    Пользователь снова написал боту — значит, сообщения до него доходят.
+    Запись условная: для доступного пользователя она ничего не меняет.
+    """
+    return await writer.submit(
+        [(
+            "UPDATE users SET reachable = 1, failure_count = 0, last_error = NULL "
+            "WHERE user_id = ? AND reachable = 0",
+            (user_id,)
+        )],
+        wait=wait
+    )
+
+# Обновление лучшего результата: новый результат заменяет прежний, только если он выше
+# (или равен, но был получен раньше — это нужно, когда оценки проставляются пачкой задним числом)
+BEST_SCORE_UPSERT = '''
+    ON CONFLICT(game_id, user_id) DO UPDATE SET score = excluded.score, result_id = excluded.result_id
+    WHERE excluded.score > best_scores.score
+       OR (excluded.score = best_scores.score AND excluded.result_id < best_scores.result_id)
+'''
+
+# Исходы submit_result
+SUBMIT_ACCEPTED = 'accepted'
+SUBMIT_NO_ATTEMPTS = 'no_attempts'
+SUBMIT_GAME_OVER = 'game_over'
+
+def _result_statements(game_id, user_id, username, prompt_text, score, max_attempts=None):
+    """
+    Единица записи результата: счетчик попыток участника, сам результат и лучший результат.
+    Счетчик увеличивается, только пока игра активна, а с max_attempts — еще и пока он меньше лимита.
+    Если первое выражение ничего не изменило, следующие за ним (по changes()) тоже ничего не вставляют:
+    ответ, пришедший после остановки игры, не попадет в результаты уже подведенного раунда.
+    """
+    limit = ' WHERE participants.attempts < ?' if max_attempts is not None else ''
+    statements = [
+        (
+            'INSERT INTO participants (game_id, user_id, attempts) '
+            "SELECT ?, ?, 1 WHERE EXISTS (SELECT 1 FROM games WHERE game_id = ? AND status = 'active') "
+            'ON CONFLICT(game_id, user_id) DO UPDATE SET attempts = attempts + 1' + limit,
+            (game_id, user_id, game_id) + ((max_attempts,) if max_attempts is not None else ())
+        ),
+        (
+            'INSERT INTO results (game_id, user_id, username, prompt_text, score, timestamp) '
+            'SELECT ?, ?, ?, ?, ?, ? WHERE changes() > 0',
             (game_id, user_id, username, prompt_text, score, datetime.now())
+        ),
+    ]
+    if score is not None:
+        # В той же единице записи, что и сам результат: таблица лучших результатов не отстает от results
+        statements.append((
+            'INSERT INTO best_scores (game_id, user_id, score, result_id) '
+            'SELECT ?, ?, ?, last_insert_rowid() WHERE changes() > 0' + BEST_SCORE_UPSERT,
+            (game_id, user_id, score)
+        ))
+    return statements
+
+async def add_result(game_id, user_id, username, prompt_text, score, wait=False):
+    """
+    Записывает результат активной игры без проверки лимита попыток
+    (счетчик попыток все равно увеличивается).
+    """
+    return await writer.submit(_result_statements(game_id, user_id, username, prompt_text, score), wait=wait)
+
+async def submit_result(game_id, user_id, username, prompt_text, score, max_attempts):
+    """
+    Принимает ответ игрока, если игра еще активна и у него остались попытки: проверки и запись
+    результата выполняются одной единицей записи (одна транзакция), поэтому два быстрых сообщения
+    подряд не пройдут проверку оба, а ответ не попадет в уже остановленную игру.
+    Возвращает SUBMIT_ACCEPTED, SUBMIT_NO_ATTEMPTS или SUBMIT_GAME_OVER.
+    """
+    counts = await writer.submit(
+        _result_statements(game_id, user_id, username, prompt_text, score, max_attempts), wait=True
+    )
+    if counts[0] > 0:
+        return SUBMIT_ACCEPTED
+    # Ответ отклонен; игра может только перейти из активной в завершенную, поэтому причина определяется
+    # по ее текущему статусу
+    if await get_game_status(game_id) != 'active':
+        return SUBMIT_GAME_OVER
+    return SUBMIT_NO_ATTEMPTS
+
+async def get_unscored_results(game_id):
+    """Ответы, сохраненные без оценки (отложенный режим): [(id, prompt_text)]."""
+    # Записи, стоящие в очереди писателя, тоже должны попасть в выборку
+    await writer.flush()
+    async with pool.acquire() as db:
+        cursor = await db.execute(
+            "SELECT id, prompt_text FROM results WHERE game_id = ? AND score IS NULL",
+            (game_id,)
+        )
+        return [(row[0], row[1]) for row in await cursor.fetchall()]
+
+async def update_result_scores(scores):
+    """
+    Записывает оценки пачкой в одной транзакции и обновляет лучшие результаты.
+    scores — пары (result_id, score).
+    """
+    async with pool.acquire() as db:
+        await db.executemany(
+            "UPDATE results SET score = ? WHERE id = ?",
+            [(score, result_id) for result_id, score in scores]
         )
+        await db.executemany(
+            "INSERT INTO best_scores (game_id, user_id, score, result_id) "
+            "SELECT game_id, user_id, score, id FROM results WHERE id = ?" + BEST_SCORE_UPSERT,
+            [(result_id,) for result_id, _ in scores]
+        )
+        await db.commit()
+
+async def rebuild_best_scores(game_id=None):
+    """Пересобирает таблицу лучших результатов по results: для одной игры или для всех."""
+    async with pool.acquire() as db:
+        if game_id is None:
+            await db.execute("DELETE FROM best_scores")
+            cursor = await db.execute(BEST_SCORES_FILL.format(condition=''))
+        else:
+            await db.execute("DELETE FROM best_scores WHERE game_id = ?", (game_id,))
+            cursor = await db.execute(BEST_SCORES_FILL.format(condition='AND game_id = ?'), (game_id,))
         await db.commit()
+        return cursor.rowcount
 
 async def get_user_attempts(game_id, user_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        cursor = await db.execute('SELECT COUNT(*) FROM results WHERE game_id = ? AND user_id = ?', (game_id, user_id))
+    async with pool.acquire() as db:
+        cursor = await db.execute(
+            'SELECT attempts FROM participants WHERE game_id = ? AND user_id = ?', (game_id, user_id)
+        )
         row = await cursor.fetchone()
         return row[0] if row else 0
 
+ALL_RESULTS_QUERY = '''
+    SELECT r.user_id, r.username, r.prompt_text, r.score, r.timestamp, u.phone_number
+    FROM results r
+    LEFT JOIN users u ON r.user_id = u.user_id
+    WHERE r.game_id = ? 
+    ORDER BY r.score DESC
+'''
+
+# Одна строка на участника: лучший ответ из таблицы best_scores, от победителя вниз
+BEST_RESULTS_QUERY = '''
+    SELECT r.user_id, r.username, r.prompt_text, b.score, r.timestamp, u.phone_number
+    FROM best_scores b
+    JOIN results r ON r.id = b.result_id
+    LEFT JOIN users u ON u.user_id = b.user_id
+    WHERE b.game_id = ?
+    ORDER BY b.score DESC, b.result_id
+'''
+
 async def get_all_results(game_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            '''
-            SELECT r.user_id, r.username, r.prompt_text, r.score, r.timestamp, u.phone_number
-            FROM results r
-            LEFT JOIN users u ON r.user_id = u.user_id
-            WHERE r.game_id = ? 
-            ORDER BY r.score DESC
-            ''',
-            (game_id,)
-        )
+    async with pool.acquire() as db:
+        cursor = await db.execute(ALL_RESULTS_QUERY, (game_id,))
         return await cursor.fetchall()
 
 async def get_best_results(game_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute('''
-            SELECT r.user_id, r.username, r.prompt_text, r.score, r.timestamp, u.phone_number
-            FROM results r
-            LEFT JOIN users u ON r.user_id = u.user_id
-            INNER JOIN (
-                SELECT user_id, MAX(score) as max_score
-                FROM results
-                WHERE game_id = ?
-                GROUP BY user_id
-            ) AS best_scores ON r.user_id = best_scores.user_id AND r.score = best_scores.max_score
-            WHERE r.game_id = ?
-            ORDER BY r.score DESC
-        ''', (game_id, game_id))
+    async with pool.acquire() as db:
+        cursor = await db.execute(BEST_RESULTS_QUERY, (game_id,))
         return await cursor.fetchall()
 
+async def get_game_winner(game_id):
+    """Лучший ответ игры (при равенстве баллов — более ранний) или None."""
+    async with pool.acquire() as db:
+        cursor = await db.execute(BEST_RESULTS_QUERY + ' LIMIT 1', (game_id,))
+        return await cursor.fetchone()
+
+async def iter_results(game_id, best=False, chunk_size=1000):
+    """Отдает результаты игры частями по chunk_size строк, не загружая их в память целиком."""
+    async with pool.acquire() as db:
+        cursor = await db.execute(BEST_RESULTS_QUERY if best else ALL_RESULTS_QUERY, (game_id,))
+        while True:
+            rows = await cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
 async def get_user_result_for_game(game_id, user_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        db.row_factory = aiosqlite.Row
+    async with pool.acquire() as db:
         cursor = await db.execute(
-            "SELECT score FROM results WHERE game_id = ? AND user_id = ? ORDER BY score DESC LIMIT 1",
+            "SELECT score FROM best_scores WHERE game_id = ? AND user_id = ?",
             (game_id, user_id)
         )
         row = await cursor.fetchone()
         return row['score'] if row else 0
 
+async def get_best_scores(game_id):
+    """Лучший результат каждого участника игры одним запросом: {user_id: score}."""
+    async with pool.acquire() as db:
+        cursor = await db.execute("SELECT user_id, score FROM best_scores WHERE game_id = ?", (game_id,))
+        return {row[0]: row[1] for row in await cursor.fetchall()}
+
 async def get_current_active_game():
-    async with aiosqlite.connect('prompt_battle.db') as db:
+    async with pool.acquire() as db:
         cursor = await db.execute(
             "SELECT game_id FROM games WHERE status = 'active' ORDER BY id DESC LIMIT 1"
         )
         row = await cursor.fetchone()
         return row[0] if row else None
 
+async def get_active_game_record():
+    async with pool.acquire() as db:
+        cursor = await db.execute(
+            "SELECT game_id, prompt, photo_id FROM games WHERE status = 'active' ORDER BY id DESC LIMIT 1"
+        )
+        return await cursor.fetchone()
+
 async def get_last_finished_game():
-    async with aiosqlite.connect('prompt_battle.db') as db:
+    async with pool.acquire() as db:
         cursor = await db.execute(
             "SELECT game_id FROM games WHERE status = 'finished' ORDER BY id DESC LIMIT 1"
         )
@@ -233,29 +399,169 @@ async def get_last_finished_game():
         return row[0] if row else None
 
 async def has_user_won(game_id, user_id):
-    async with aiosqlite.connect('prompt_battle.db') as db:
+    async with pool.acquire() as db:
         cursor = await db.execute(
-            'SELECT 1 FROM results WHERE game_id = ? AND user_id = ? AND score = 100',
+            'SELECT 1 FROM best_scores WHERE game_id = ? AND user_id = ? AND score = 100',
             (game_id, user_id)
         )
         row = await cursor.fetchone()
         return row is not None
 
-async def set_user_attempts_to_max(game_id, user_id, max_attempts):
-    async with aiosqlite.connect('prompt_battle.db') as db:
-        # Удаляем предыдущие попытки
-        await db.execute('DELETE FROM results WHERE game_id = ? AND user_id = ?', (game_id, user_id))
-        # Вставляем "пустые" записи, чтобы счетчик попыток достиг максимума
-        for _ in range(max_attempts):
-            await db.execute(
-                'INSERT INTO results (game_id, user_id, username, prompt_text, score, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
-                (game_id, user_id, 'winner', 'winner_prompt', 100, datetime.now())
-            )
-        await db.commit()
+async def set_user_attempts_to_max(game_id, user_id, max_attempts, wait=False):
+    """Исчерпывает попытки пользователя в игре: дальнейшие ответы submit_result отклонит."""
+    return await writer.submit(
+        [(
+            'INSERT INTO participants (game_id, user_id, attempts) VALUES (?, ?, ?) '
+            'ON CONFLICT(game_id, user_id) DO UPDATE SET attempts = MAX(attempts, excluded.attempts)',
+            (game_id, user_id, max_attempts)
+        )],
+        wait=wait
+    )
 
 async def get_finished_games():
-    async with aiosqlite.connect('prompt_battle.db') as db:
+    async with pool.acquire() as db:
         cursor = await db.execute(
             "SELECT game_id, prompt FROM games WHERE status = 'finished' ORDER BY id DESC"
         )
         return await cursor.fetchall()
+
+
+# Очередь рассылок: каждая рассылка — строка broadcasts и по строке outbox на получателя.
+# Строки получателей удаляются при завершении рассылки, итоги остаются в broadcasts.
+async def create_broadcast(key, title, text, recipients):
+    """
+    Создает рассылку с получателями одной транзакцией. recipients — пары (chat_id, текст),
+    текст None означает общий text рассылки. Если рассылка с таким key уже есть,
+    получатели не добавляются. Возвращает (broadcast_id, создана ли рассылка сейчас).
+    """
+    async with pool.acquire() as db:
+        await db.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = await db.execute(
+                'INSERT OR IGNORE INTO broadcasts (key, title, text, created_at) VALUES (?, ?, ?, ?)',
+                (key, title, text, time.time())
+            )
+            if cursor.rowcount == 0:
+                await db.rollback()
+                cursor = await db.execute('SELECT id FROM broadcasts WHERE key = ?', (key,))
+                return (await cursor.fetchone())[0], False
+            broadcast_id = cursor.lastrowid
+            await db.executemany(
+                'INSERT OR IGNORE INTO outbox (broadcast_id, chat_id, text) VALUES (?, ?, ?)',
+                ((broadcast_id, chat_id, chat_text) for chat_id, chat_text in recipients)
+            )
+            await db.execute(
+                'UPDATE broadcasts SET total = (SELECT COUNT(*) FROM outbox WHERE broadcast_id = ?) WHERE id = ?',
+                (broadcast_id, broadcast_id)
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+    return broadcast_id, True
+
+async def get_broadcast(broadcast_id):
+    async with pool.acquire() as db:
+        cursor = await db.execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
+        return await cursor.fetchone()
+
+async def get_unfinished_broadcasts():
+    async with pool.acquire() as db:
+        cursor = await db.execute('SELECT id FROM broadcasts WHERE finished_at IS NULL ORDER BY id')
+        return [row[0] for row in await cursor.fetchall()]
+
+async def claim_outbox(broadcast_id, limit):
+    """Забирает очередную пачку получателей: [(chat_id, текст или None)], помечая их как отправляемые."""
+    async with pool.acquire() as db:
+        cursor = await db.execute(
+            "SELECT chat_id, text FROM outbox WHERE broadcast_id = ? AND status = 'pending' LIMIT ?",
+            (broadcast_id, limit)
+        )
+        rows = await cursor.fetchall()
+        if rows:
+            await db.executemany(
+                "UPDATE outbox SET status = 'sending' WHERE broadcast_id = ? AND chat_id = ?",
+                ((broadcast_id, row[0]) for row in rows)
+            )
+            await db.execute(
+                'UPDATE broadcasts SET started_at = COALESCE(started_at, ?) WHERE id = ?', (time.time(), broadcast_id)
+            )
+            await db.commit()
+        return [(row[0], row[1]) for row in rows]
+
+async def mark_outbox(broadcast_id, outcomes, max_failures=USER_MAX_FAILURES):
+    """
+    Записывает исходы отправки и доступность получателей. outcomes — четверки
+    (chat_id, статус, ошибка, постоянная ли ошибка). Заблокировавший бота пользователь сразу
+    исключается из рассылок, а после постоянных ошибок этого чата (например, «chat not found») —
+    после max_failures таких доставок подряд. Временные сбои (flood control, сеть, ошибки сервера
+    Telegram) только записываются в last_error: они говорят о Telegram, а не о пользователе.
+    Успешная доставка сбрасывает счетчик. Возвращает получателей, которые теперь исключены из рассылок.
+    """
+    if not outcomes:
+        return []
+    async with pool.acquire() as db:
+        await db.executemany(
+            'UPDATE outbox SET status = ?, error = ? WHERE broadcast_id = ? AND chat_id = ?',
+            ((status, error, broadcast_id, chat_id) for chat_id, status, error, _ in outcomes)
+        )
+        await db.executemany(
+            'UPDATE users SET failure_count = 0, last_error = NULL WHERE user_id = ? AND failure_count > 0',
+            ((chat_id,) for chat_id, status, _, _ in outcomes if status == 'sent')
+        )
+        await db.executemany(
+            '''
+            UPDATE users SET
+                failure_count = failure_count + :counted,
+                last_error = :error,
+                reachable = CASE WHEN :blocked OR (:counted AND failure_count + 1 >= :max) THEN 0 ELSE reachable END
+            WHERE user_id = :user_id
+            ''',
+            ({'counted': int(permanent), 'error': error, 'blocked': status == 'blocked', 'max': max_failures,
+              'user_id': chat_id}
+             for chat_id, status, error, permanent in outcomes if status != 'sent')
+        )
+        await db.commit()
+        counted = [chat_id for chat_id, _, _, permanent in outcomes if permanent]
+        if not counted:
+            return []
+        cursor = await db.execute(
+            f"SELECT user_id FROM users WHERE reachable = 0 AND user_id IN ({','.join('?' * len(counted))})",
+            counted
+        )
+        return [row[0] for row in await cursor.fetchall()]
+
+async def requeue_outbox(broadcast_id):
+    """Возвращает в очередь получателей, взятых до сбоя, исход отправки которым неизвестен."""
+    async with pool.acquire() as db:
+        cursor = await db.execute(
+            "UPDATE outbox SET status = 'pending' WHERE broadcast_id = ? AND status = 'sending'", (broadcast_id,)
+        )
+        await db.commit()
+        return cursor.rowcount
+
+async def get_outbox_counts(broadcast_id):
+    """Число получателей рассылки по статусам."""
+    async with pool.acquire() as db:
+        cursor = await db.execute(
+            'SELECT status, COUNT(*) FROM outbox WHERE broadcast_id = ? GROUP BY status', (broadcast_id,)
+        )
+        return {row[0]: row[1] for row in await cursor.fetchall()}
+
+async def finish_broadcast(broadcast_id):
+    """Переносит итоги рассылки в broadcasts и удаляет строки ее получателей."""
+    async with pool.acquire() as db:
+        await db.execute('''
+            UPDATE broadcasts SET
+                sent = (SELECT COUNT(*) FROM outbox WHERE broadcast_id = :id AND status = 'sent'),
+                blocked = (SELECT COUNT(*) FROM outbox WHERE broadcast_id = :id AND status = 'blocked'),
+                failed = (SELECT COUNT(*) FROM outbox WHERE broadcast_id = :id AND status = 'failed'),
+                finished_at = :now
+            WHERE id = :id AND finished_at IS NULL
+        ''', {'id': broadcast_id, 'now': time.time()})
+        await db.execute('DELETE FROM outbox WHERE broadcast_id = ?', (broadcast_id,))
+        await db.commit()
+
+
+# Замер времени каждой функции модуля (в конце, чтобы импортирующие модули получили обертки)
+instrument_module(globals(), DB_SECONDS, DB_ERRORS, skip={'open_db', 'close_db'})
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DEFAULT_DESTINY, StorageKey, StateType
+from config.config import FSM_STATE_TTL, FSM_CACHE_SIZE, FSM_SWEEP_INTERVAL
+from db.database import pool, writer
+
+logger = logging.getLogger(__name__)
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'updated_at')
+
+    def __init__(self, state, data, updated_at):
+        self.state = state
+        self.data = data
+        self.updated_at = updated_at
+
+    @property
+    def empty(self):
+        return self.state is None and not self.data
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в таблице fsm_states с LRU-кешем в памяти.
+
+    Кеш сквозной: чтения обслуживаются из памяти (в том числе "состояния нет" — это тоже запись
+    кеша, иначе каждое обновление ходило бы в БД), а запись сразу меняет кеш и ставится в очередь
+    группового писателя, не дожидаясь фиксации. Пустое состояние удаляет строку из таблицы.
+    Состояния, которые не менялись дольше ttl секунд, считаются протухшими и периодически удаляются.
+    """
+
+    def __init__(self, ttl=FSM_STATE_TTL, cache_size=FSM_CACHE_SIZE, sweep_interval=FSM_SWEEP_INTERVAL):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.sweep_interval = sweep_interval
+        self._cache = OrderedDict()
+        # Незафиксированные записи по ключу: перечитывать из БД можно только после них
+        self._pending = {}
+        self._sweeper = None
+
+    @staticmethod
+    def _key(key: StorageKey):
+        # Компактный ключ: бот в базе один, поэтому bot_id не храним,
+        # а необязательные части добавляем только если они заданы
+        parts = [str(key.chat_id), str(key.user_id)]
+        if key.thread_id:
+            parts.append(f"t{key.thread_id}")
+        if key.business_connection_id:
+            parts.append(f"b{key.business_connection_id}")
+        if key.destiny != DEFAULT_DESTINY:
+            parts.append(f"d{key.destiny}")
+        return ':'.join(parts)
+
+    def _expired(self, record):
+        return self.ttl > 0 and record.updated_at < time.time() - self.ttl
+
+    def _remember(self, key, record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key):
+        if self._sweeper is None and self.sweep_interval > 0:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+        record = self._cache.get(key)
+        if record is None:
+            pending = self._pending.get(key)
+            if pending is not None:
+                await asyncio.shield(pending)
+            async with pool.acquire() as db:
+                cursor = await db.execute(
+                    "SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key,)
+                )
+                row = await cursor.fetchone()
+            if row:
+                record = _Record(row[0], json.loads(row[1]) if row[1] else {}, row[2])
+            else:
+                record = _Record(None, {}, time.time())
+            self._remember(key, record)
+        else:
+            self._cache.move_to_end(key)
+
+        if not record.empty and self._expired(record):
+            record = _Record(None, {}, time.time())
+            self._remember(key, record)
+            await self._persist(key, record)
+        return record
+
+    async def _persist(self, key, record):
+        if record.empty:
+            statements = [("DELETE FROM fsm_states WHERE key = ?", (key,))]
+        else:
+            data = json.dumps(record.data, ensure_ascii=False, separators=(',', ':')) if record.data else None
+            statements = [(
+                '''
+                INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                state=excluded.state, data=excluded.data, updated_at=excluded.updated_at
+                ''',
+                (key, record.state, data, record.updated_at)
+            )]
+        future = await writer.submit(statements)
+        self._pending[key] = future
+        future.add_done_callback(lambda _: self._forget_pending(key, future))
+
+    def _forget_pending(self, key, future):
+        if self._pending.get(key) is future:
+            del self._pending[key]
+
+    async def _update(self, key, state=..., data=...):
+        current = await self._load(key)
+        record = _Record(
+            current.state if state is ... else state,
+            current.data if data is ... else data,
+            time.time()
+        )
+        if record.empty and current.empty:
+            # Ничего не поменялось — в БД не пишем
+            return
+        self._remember(key, record)
+        await self._persist(key, record)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._update(self._key(key), state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self._key(key))).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._update(self._key(key), data=dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._load(self._key(key))).data)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Ошибка очистки устаревших состояний FSM: {e}")
+
+    async def sweep(self):
+        """Удаляет состояния, которые не менялись дольше ttl секунд."""
+        if self.ttl <= 0:
+            return
+        deadline = time.time() - self.ttl
+        await writer.submit([("DELETE FROM fsm_states WHERE updated_at < ?", (deadline,))])
+        for key in [key for key, record in self._cache.items() if record.updated_at < deadline]:
+            del self._cache[key]
+
+    def snapshot(self):
+        return {
+            'cached': len(self._cache),
+            'pending_writes': len(self._pending),
+        }
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        # Дожидаемся, пока последние изменения состояний попадут в БД
+        await writer.flush()
@@ -0,0 +1,190 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Заполнение таблицы лучших результатов по таблице results. Лучший результат пользователя в игре —
+# максимальный балл, при равенстве — более ранний ответ. Используется миграцией и пересборкой таблицы.
+BEST_SCORES_FILL = '''
+    INSERT INTO best_scores (game_id, user_id, score, result_id)
+    SELECT game_id, user_id, score, id FROM (
+        SELECT game_id, user_id, score, id,
+               ROW_NUMBER() OVER (PARTITION BY game_id, user_id ORDER BY score DESC, id) AS place
+        FROM results
+        WHERE score IS NOT NULL {condition}
+    )
+    WHERE place = 1
+'''
+
+# Нумерованные миграции схемы. Номер последней примененной хранится в PRAGMA user_version.
+# Новые миграции только добавляются в конец списка: уже примененные не редактируются.
+MIGRATIONS = [
+    (1, "Базовая схема", [
+        # Таблица для пользователей
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            phone_number TEXT,
+            state TEXT DEFAULT 'new'
+        )
+        ''',
+        # Таблица для игр
+        '''
+        CREATE TABLE IF NOT EXISTS games (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            game_id TEXT UNIQUE,
+            prompt TEXT,
+            photo_id TEXT,
+            status TEXT DEFAULT 'pending'
+        )
+        ''',
+        # Таблица для результатов
+        '''
+        CREATE TABLE IF NOT EXISTS results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            game_id TEXT,
+            user_id INTEGER,
+            username TEXT,
+            prompt_text TEXT,
+            score INTEGER,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (game_id) REFERENCES games (game_id)
+        )
+        ''',
+        # Таблица для участников
+        '''
+        CREATE TABLE IF NOT EXISTS participants (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            game_id TEXT,
+            user_id INTEGER,
+            UNIQUE(game_id, user_id),
+            FOREIGN KEY (game_id) REFERENCES games (game_id)
+        )
+        ''',
+    ]),
+    (2, "Индексы для горячих запросов", [
+        # Поиск активной/следующей/последней завершенной игры: покрывающий индекс без обращения к таблице
+        "CREATE INDEX IF NOT EXISTS idx_games_status_id ON games (status, id, game_id)",
+        # Попытки и лучший результат пользователя в игре, лучшие результаты по игре
+        "CREATE INDEX IF NOT EXISTS idx_results_game_user_score ON results (game_id, user_id, score)",
+        # Все результаты игры, отсортированные по очкам
+        "CREATE INDEX IF NOT EXISTS idx_results_game_score ON results (game_id, score)",
+        # Активная игра пользователя
+        "CREATE INDEX IF NOT EXISTS idx_participants_user_game ON participants (user_id, game_id)",
+    ]),
+    (3, "Хранилище состояний FSM", [
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        # Очистка устаревших состояний
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states (updated_at)",
+    ]),
+    (4, "Таблица лучших результатов", [
+        # Лучший результат каждого пользователя в игре, обновляется вместе с добавлением результата
+        '''
+        CREATE TABLE IF NOT EXISTS best_scores (
+            game_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            score INTEGER NOT NULL,
+            result_id INTEGER NOT NULL,
+            PRIMARY KEY (game_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+        # Таблица лидеров игры и победитель: чтение диапазона индекса в нужном порядке
+        "CREATE INDEX IF NOT EXISTS idx_best_scores_game_score ON best_scores (game_id, score DESC, result_id)",
+        BEST_SCORES_FILL.format(condition=''),
+    ]),
+    (5, "Счетчик попыток участника", [
+        "ALTER TABLE participants ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+        # Пользователи, у которых есть результаты, но нет записи участника
+        '''
+        INSERT OR IGNORE INTO participants (game_id, user_id)
+        SELECT DISTINCT game_id, user_id FROM results
+        ''',
+        '''
+        UPDATE participants SET attempts = (
+            SELECT COUNT(*) FROM results r WHERE r.game_id = participants.game_id AND r.user_id = participants.user_id
+        )
+        ''',
+    ]),
+    (6, "Очередь рассылок (outbox)", [
+        # Рассылка целиком: ключ делает повторное создание той же рассылки безопасным,
+        # счетчики заполняются при завершении, когда строки получателей удаляются
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            title TEXT,
+            text TEXT,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+        ''',
+        # Незавершенные рассылки, которые нужно дослать после перезапуска
+        "CREATE INDEX IF NOT EXISTS idx_broadcasts_finished ON broadcasts (finished_at)",
+        # Получатель рассылки; text задан только для персональных сообщений, иначе берется из broadcasts
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            broadcast_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            text TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            PRIMARY KEY (broadcast_id, chat_id)
+        ) WITHOUT ROWID
+        ''',
+        # Выборка очередной пачки и подсчет исходов рассылки
+        "CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (broadcast_id, status)",
+    ]),
+    (7, "Доступность пользователей для рассылок", [
+        "ALTER TABLE users ADD COLUMN reachable INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE users ADD COLUMN last_error TEXT",
+        "ALTER TABLE users ADD COLUMN failure_count INTEGER NOT NULL DEFAULT 0",
+        # Получатели рассылки и число недоступных: чтение только нужной части индекса
+        "CREATE INDEX IF NOT EXISTS idx_users_reachable ON users (reachable, user_id)",
+    ]),
+]
+
+
+async def get_schema_version(db):
+    cursor = await db.execute('PRAGMA user_version')
+    row = await cursor.fetchone()
+    return row[0]
+
+
+async def apply_migrations(db):
+    """Применяет все миграции новее текущей версии схемы, каждую в своей транзакции."""
+    version = await get_schema_version(db)
+    for number, description, statements in MIGRATIONS:
+        if number <= version:
+            continue
+        await db.execute('BEGIN IMMEDIATE')
+        # Несколько процессов могут стартовать одновременно: версию перечитываем под блокировкой,
+        # чтобы одна и та же миграция не применилась дважды
+        if number <= await get_schema_version(db):
+            await db.rollback()
+            continue
+        logger.info(f"Применяю миграцию {number}: {description}")
+        try:
+            for statement in statements:
+                await db.execute(statement)
+            # PRAGMA user_version транзакционна: версия обновится только вместе со схемой
+            await db.execute(f'PRAGMA user_version = {number}')
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        version = number
+    return version
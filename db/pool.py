@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+class PoolStats:
+    """
+    Счетчики пула: сколько раз брали соединение и сколько ждали свободного.
+    """
+    __slots__ = ('acquired', 'waited', 'total_wait', 'max_wait')
+
+    def __init__(self):
+        self.acquired = 0
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait, contended):
+        self.acquired += 1
+        if contended:
+            self.waited += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+
+class ConnectionPool:
+    """
+    Пул постоянных соединений к SQLite.
+    Соединения открываются один раз при старте бота и закрываются при остановке,
+    вместо того чтобы открывать файл (и поток aiosqlite) на каждый запрос.
+    """
+
+    def __init__(self, path, size=4, busy_timeout_ms=5000, cached_statements=256):
+        self.path = path
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self.stats = PoolStats()
+        self._connections = []
+        self._idle = None
+
+    @property
+    def is_open(self):
+        return self._idle is not None
+
+    async def _connect(self):
+        # cached_statements — размер кеша подготовленных выражений sqlite3 на соединение
+        db = await aiosqlite.connect(self.path, cached_statements=self.cached_statements)
+        db.row_factory = aiosqlite.Row
+        await db.execute('PRAGMA journal_mode=WAL')
+        await db.execute('PRAGMA synchronous=NORMAL')
+        await db.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        return db
+
+    async def open(self):
+        if self.is_open:
+            return
+        idle = asyncio.Queue()
+        connections = []
+        try:
+            for _ in range(self.size):
+                db = await self._connect()
+                connections.append(db)
+                idle.put_nowait(db)
+        except Exception:
+            for db in connections:
+                await db.close()
+            raise
+        self._connections = connections
+        self._idle = idle
+        logger.info(f"Пул соединений к {self.path} открыт ({self.size} шт.)")
+
+    async def close(self):
+        if not self.is_open:
+            return
+        connections, self._connections = self._connections, []
+        self._idle = None
+        for db in connections:
+            try:
+                await db.close()
+            except Exception as e:
+                logger.error(f"Ошибка при закрытии соединения с БД: {e}")
+        logger.info("Пул соединений закрыт")
+
+    @asynccontextmanager
+    async def acquire(self):
+        if not self.is_open:
+            raise RuntimeError("Пул соединений не открыт: вызовите open_db() при старте")
+        idle = self._idle
+        contended = idle.empty()
+        started = time.perf_counter()
+        db = await idle.get()
+        self.stats.record(time.perf_counter() - started, contended)
+        try:
+            yield db
+        except BaseException:
+            # Откатываем незавершенную транзакцию, прежде чем вернуть соединение в пул
+            if db.in_transaction:
+                await db.rollback()
+            raise
+        finally:
+            idle.put_nowait(db)
+
+    async def set_trace_callback(self, callback):
+        """Включает трассировку SQL на всех соединениях пула (None — выключает)."""
+        for db in self._connections:
+            await db.set_trace_callback(callback)
+
+    def snapshot(self):
+        idle = self._idle.qsize() if self.is_open else 0
+        stats = self.stats
+        return {
+            'size': len(self._connections),
+            'idle': idle,
+            'in_use': len(self._connections) - idle,
+            'acquired': stats.acquired,
+            'waited': stats.waited,
+            'avg_wait_ms': (stats.total_wait / stats.waited * 1000) if stats.waited else 0.0,
+            'max_wait_ms': stats.max_wait * 1000,
+        }
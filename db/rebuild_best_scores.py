@@ -0,0 +1,32 @@
+"""
+Пересборка таблицы лучших результатов (best_scores) по таблице results.
+
+Таблица обновляется автоматически при каждом добавлении результата и заполняется миграцией,
+поэтому пересборка нужна только после ручной правки results. Можно запускать при работающем боте.
+
+Запуск: python -m db.rebuild_best_scores [game_id]
+"""
+import asyncio
+import sys
+
+from db import database
+
+
+async def rebuild(game_id=None):
+    await database.open_db()
+    try:
+        await database.init_db()
+        return await database.rebuild_best_scores(game_id)
+    finally:
+        await database.close_db()
+
+
+def main():
+    game_id = sys.argv[1] if len(sys.argv) > 1 else None
+    count = asyncio.run(rebuild(game_id))
+    target = f"игры {game_id}" if game_id else "всех игр"
+    print(f"Таблица лучших результатов {target} пересобрана: {count} строк.")
+
+
+if __name__ == '__main__':
+    main()
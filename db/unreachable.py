@@ -0,0 +1,36 @@
+import time
+from config.config import UNREACHABLE_REFRESH_INTERVAL
+from db.database import get_unreachable_user_ids
+
+
+class UnreachableUsers:
+    """
+    Множество пользователей, исключенных из рассылок, в памяти процесса.
+
+    Хендлеры без сессии (например, отправка ответа в игре) проверяют по нему, нужно ли вернуть
+    пользователя в рассылки, не обращаясь к БД на каждом обновлении. Доставка рассылки добавляет
+    исключенных получателей сразу, а исключенных в других процессах множество узнает при
+    перечитывании из БД не реже раза в refresh_interval секунд.
+    """
+
+    def __init__(self, refresh_interval=UNREACHABLE_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._ids = set()
+        self._loaded_at = None
+
+    async def contains(self, user_id):
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at >= self.refresh_interval:
+            # Отметку ставим до запроса, чтобы одновременные обновления не перечитывали множество все разом
+            self._loaded_at = now
+            self._ids = set(await get_unreachable_user_ids())
+        return user_id in self._ids
+
+    def add(self, user_ids):
+        self._ids.update(user_ids)
+
+    def discard(self, user_id):
+        self._ids.discard(user_id)
+
+
+unreachable_users = UnreachableUsers()
@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriterStats:
+    __slots__ = ('batches', 'units', 'statements', 'failed_units', 'retries', 'lost_units', 'last_batch_ms')
+
+    def __init__(self):
+        self.batches = 0
+        self.units = 0
+        self.statements = 0
+        self.failed_units = 0
+        # Повторы пачек после временной ошибки и единицы, потерянные после исчерпания повторов
+        self.retries = 0
+        self.lost_units = 0
+        self.last_batch_ms = 0.0
+
+
+class WriteBehindQueue:
+    """
+    Единственный писатель в SQLite с групповой фиксацией.
+
+    Хендлеры ставят записи в ограниченную очередь, а фоновая задача собирает их в пачки
+    и применяет одной транзакцией каждые flush_ms миллисекунд или каждые batch_size
+    выражений — что наступит раньше. Так на всплеск событий приходится один fsync на пачку,
+    а не на каждую запись.
+
+    Единица записи — список пар (sql, params), который применяется атомарно (через SAVEPOINT):
+    ошибка в одной единице не откатывает остальные записи пачки. Результат единицы —
+    список rowcount по каждому выражению.
+
+    Если не удалось начать или зафиксировать саму транзакцию пачки (например, "database is locked"
+    после busy_timeout), пачка повторяется целиком до retries раз с удваивающейся паузой.
+    Многие записи ставятся в очередь без ожидания результата, поэтому временная блокировка
+    не должна молча их терять: ошибку получают только после исчерпания повторов.
+    """
+
+    def __init__(self, pool, batch_size=200, flush_ms=20, max_queue=10000, retries=5, retry_delay_ms=100):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.retries = retries
+        self.retry_delay = retry_delay_ms / 1000
+        self.stats = WriterStats()
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._task = None
+
+    @property
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self.is_running:
+            return
+        # Очередь привязывается к текущему циклу событий при первом использовании
+        self._queue = asyncio.Queue(maxsize=self._queue.maxsize)
+        self._task = asyncio.create_task(self._run(), name='db-writer')
+
+    async def stop(self):
+        """Дописывает все, что накопилось в очереди, и останавливает писателя."""
+        if not self.is_running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, statements, wait=False):
+        """
+        Ставит единицу записи в очередь. Если очередь заполнена, ждет освобождения места.
+        При wait=True дожидается фиксации транзакции и возвращает rowcount по каждому выражению,
+        иначе возвращает future, которую можно дождаться позже.
+        """
+        if not self.is_running:
+            # Писатель не запущен (например, в служебных скриптах) — пишем сразу
+            result = await self._execute_direct(statements)
+            if wait:
+                return result
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(result)
+            return future
+
+        future = asyncio.get_running_loop().create_future()
+        if not wait:
+            future.add_done_callback(_consume_exception)
+        await self._queue.put((statements, future))
+        if wait:
+            return await future
+        return future
+
+    async def flush(self):
+        """Дожидается фиксации всего, что было поставлено в очередь до этого вызова."""
+        if self.is_running:
+            await self.submit([], wait=True)
+
+    async def _execute_direct(self, statements):
+        async with self.pool.acquire() as db:
+            counts = []
+            for sql, params in statements:
+                cursor = await db.execute(sql, params)
+                counts.append(cursor.rowcount)
+            await db.commit()
+            return counts
+
+    async def _collect(self, first):
+        batch = [first]
+        size = len(first[0])
+        deadline = time.monotonic() + self.flush_interval
+        while size < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+            size += len(item[0])
+        return batch, False
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                stopping = True
+                batch = []
+            else:
+                batch, stopping = await self._collect(first)
+            if stopping:
+                # Забираем все, что успели положить до сигнала остановки
+                while not self._queue.empty():
+                    item = self._queue.get_nowait()
+                    if item is not None:
+                        batch.append(item)
+            if batch:
+                await self._flush(batch)
+
+    async def _flush(self, batch):
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                outcomes = await self._apply(batch)
+                break
+            except sqlite3.OperationalError as e:
+                if attempt >= self.retries:
+                    self._fail(batch, e)
+                    return
+                delay = self.retry_delay * 2 ** attempt
+                attempt += 1
+                self.stats.retries += 1
+                logger.warning(f"Не удалось зафиксировать пачку записей ({len(batch)} шт.): {e}. "
+                               f"Повтор {attempt} из {self.retries} через {delay:.2f} с")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                self._fail(batch, e)
+                return
+
+        # Результаты отдаются только после фиксации: до нее пачка еще может быть повторена
+        for (_, future), (counts, error) in zip(batch, outcomes):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(counts)
+            else:
+                future.set_exception(error)
+
+        stats = self.stats
+        stats.batches += 1
+        stats.units += len(batch)
+        stats.statements += sum(len(statements) for statements, _ in batch)
+        stats.last_batch_ms = (time.perf_counter() - started) * 1000
+
+    async def _apply(self, batch):
+        """Применяет пачку одной транзакцией; возвращает (rowcount-ы, ошибка) по каждой единице."""
+        async with self.pool.acquire() as db:
+            await db.execute('BEGIN IMMEDIATE')
+            try:
+                outcomes = []
+                for statements, _ in batch:
+                    await db.execute('SAVEPOINT unit')
+                    try:
+                        counts = []
+                        for sql, params in statements:
+                            cursor = await db.execute(sql, params)
+                            counts.append(cursor.rowcount)
+                    except sqlite3.OperationalError as e:
+                        if not _is_unit_error(e):
+                            raise
+                        outcomes.append(await self._rollback_unit(db, e))
+                        continue
+                    except Exception as e:
+                        outcomes.append(await self._rollback_unit(db, e))
+                        continue
+                    await db.execute('RELEASE unit')
+                    outcomes.append((counts, None))
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+        return outcomes
+
+    async def _rollback_unit(self, db, error):
+        await db.execute('ROLLBACK TO unit')
+        await db.execute('RELEASE unit')
+        self.stats.failed_units += 1
+        logger.error(f"Ошибка записи в БД: {error}")
+        return None, error
+
+    def _fail(self, batch, error):
+        self.stats.lost_units += len(batch)
+        logger.error(f"Не удалось зафиксировать пачку записей ({len(batch)} шт.), записи потеряны: {error}")
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def snapshot(self):
+        stats = self.stats
+        return {
+            'running': self.is_running,
+            'queue_depth': self.depth,
+            'queue_limit': self._queue.maxsize,
+            'batches': stats.batches,
+            'units': stats.units,
+            'statements': stats.statements,
+            'failed_units': stats.failed_units,
+            'retries': stats.retries,
+            'lost_units': stats.lost_units,
+            'avg_batch_size': stats.units / stats.batches if stats.batches else 0.0,
+            'last_batch_ms': stats.last_batch_ms,
+        }
+
+
+def _is_unit_error(error):
+    """
+    OperationalError внутри единицы: ошибка самого выражения (например, нет такой таблицы
+    или столбца) касается только этой единицы, а блокировка или сбой диска — всей пачки.
+    """
+    message = str(error).lower()
+    return not any(text in message for text in ('locked', 'busy', 'disk i/o'))
+
+
+def _consume_exception(future):
+    # Ошибка уже залогирована писателем; помечаем ее как полученную,
+    # чтобы asyncio не ругался на "Future exception was never retrieved"
+    if not future.cancelled():
+        future.exception()
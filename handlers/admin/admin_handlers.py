@@ -1,3 +1,4 @@
+import logging
 import random
 import string
 from aiogram import types, Router, F, Bot
@@ -5,15 +6,23 @@ from aiogram.exceptions import TelegramForbiddenError
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from openpyxl import Workbook
 from config.config import ADMIN_IDS
-from db.database import (add_game, stop_game, get_all_results, get_best_results, get_game,
+from db.database import (add_game, stop_game, get_game_winner, get_game,
                          get_game_status, get_participants, get_current_active_game, get_finished_games,
-                         get_all_user_ids, get_user_result_for_game, start_next_game)
-import io
-from aiogram.types import BufferedInputFile
+                         get_reachable_user_ids, get_unreachable_user_count, get_best_scores, start_next_game,
+                         has_pending_games, get_unscored_results, update_result_scores,
+                         get_unfinished_broadcasts, get_broadcast)
+from db.active_game import active_game
+from utils.broadcast import send_broadcast, deliver
+from utils.scoring import scorer
+from utils.similarity import build_reference_profile
+from utils.export import export_file_name, export_results
+from utils.jobs import jobs, Job, JobConflict
+import os
+from aiogram.types import FSInputFile
 
 admin_router = Router()
+logger = logging.getLogger(__name__)
 
 class CreateGame(StatesGroup):
     waiting_for_photo = State()
@@ -31,12 +40,14 @@ async def admin_help_command(message: types.Message):
         "/startgame - Запустить первую игру из очереди\n"
         "/continuegame - Запустить следующую игру из очереди\n"
         "/stopgame - Остановить активную игру\n"
+        "/jobs - Фоновые задачи\n"
+        "/canceljob <id> - Отменить фоновую задачу\n"
         "/excel - Экспортировать результаты\n"
         "/senduser <id> <message> - Отправить сообщение пользователю"
     )
 
 @admin_router.message(Command("makegame"), F.from_user.id.in_(ADMIN_IDS))
-async def make_game_command(message types.Message, state: FSMContext):
+async def make_game_command(message: types.Message, state: FSMContext):
     await message.answer("Загрузите фото для новой игры.")
     await state.set_state(CreateGame.waiting_for_photo)
 
@@ -59,67 +70,85 @@ async def prompt_sent(message: types.Message, state: FSMContext):
     await message.answer(f"Игра успешно добавлена в очередь. ID игры: `{game_id}`. Используйте /startgame, чтобы начать.")
 
 
-async def start_game_logic(message: types.Message, bot: Bot):
-    game_id = await start_next_game()
-    if not game_id:
-        await message.answer("Нет ожидающих игр для запуска.")
-        return
+# Группа задач смены раунда: остановка, запуск и продолжение игры не выполняются одновременно
+ROUND_JOBS = 'round'
 
-    game_data = await get_game(game_id)
-    if not game_data:
-        await message.answer("Не удалось получить данные для запуска игры.")
-        return
-    
-    _, photo_id = game_data
-    
-    all_user_ids = await get_all_user_ids()
-    sent_count = 0
-    for user_id in all_user_ids:
-        try:
-            # Убираем фото на старте раунда
-            await bot.send_message(user_id, "Новый раунд начался! Нажмите /start, чтобы присоединиться")
-            sent_count += 1
-        except TelegramForbiddenError:
-            print(f"Не удалось отправить сообщение пользователю {user_id}: бот заблокирован или это другой бот.")
-        except Exception as e:
-            print(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+async def start_game_logic(bot: Bot, job: Job):
+    if not await has_pending_games():
+        return "Нет ожидающих игр для запуска."
 
-    await message.answer(f"Игра `{game_id}` успешно запущена. Уведомление разослано {sent_count} из {len(all_user_ids)} пользователей.")
+    # Текущая игра завершается как при /stopgame: с оценкой отложенных ответов,
+    # выбором победителя и рассылкой итогов
+    if await get_current_active_game():
+        job.note(await stop_game_logic(bot, job))
 
-@admin_router.message(Command("startgame"), F.from_user.id.in_(ADMIN_IDS))
-async def start_game_command(message: types.Message, bot: Bot):
-    await start_game_logic(message, bot)
+    game_id = await start_next_game()
+    if not game_id:
+        return "Нет ожидающих игр для запуска."
+
+    # Подменяем запись активной игры в кеше, из которого читают пользовательские хендлеры
+    game = await active_game.reload()
+    if not game:
+        return "Не удалось получить данные для запуска игры."
+
+    # Заблокировавшие бота и недоступные пользователи в рассылку не попадают
+    user_ids = await get_reachable_user_ids()
+    pruned = await get_unreachable_user_count()
+    job.note(f"Игра {game_id} запущена. Рассылаю уведомления {len(user_ids)} пользователям "
+             f"(недоступных пропущено: {pruned}).")
+    progress = await announce_round(bot, job, game_id, user_ids)
+    return (f"Игра {game_id} успешно запущена. Уведомление разослано {progress.sent} из {progress.total} "
+            f"пользователей ({progress.rate:.0f} сообщ./с).")
+
+def progress_reporter(job: Job, title):
+    async def report(progress):
+        job.report(progress.format(title))
+    return report
+
+def delivery_options(job: Job, title):
+    # Рассылку завершает только отмена задачи администратором; при остановке бота она остается
+    # в outbox и досылается после перезапуска
+    return dict(on_progress=progress_reporter(job, title), abandon_on_cancel=lambda: job.cancel_requested)
+
+async def announce_round(bot: Bot, job: Job, game_id, user_ids):
+    # Убираем фото на старте раунда.
+    # Ключ рассылки привязан к игре: после перезапуска та же рассылка досылается, а не начинается заново
+    title = f"Рассылка о старте игры {game_id}"
+    return await send_broadcast(
+        bot, f"start:{game_id}", title, user_ids, "Новый раунд начался! Нажмите /start, чтобы присоединиться",
+        **delivery_options(job, title)
+    )
 
-async def stop_game_logic(message: types.Message, bot: Bot, is_continue: bool = False):
+async def stop_game_logic(bot: Bot, job: Job):
     game_id = await get_current_active_game()
     if not game_id:
-        if not is_continue:
-            await message.answer("Нет активных игр для остановки.")
-        return
+        return "Нет активных игр для остановки."
 
+    # Сначала убираем игру из кеша, чтобы новые ответы перестали приниматься.
+    # Другие процессы перечитывают игру из БД, поэтому оповещаем их только после записи остановки
+    active_game.clear(notify=False)
     await stop_game(game_id)
+    active_game.notify()
     
     participants = await get_participants(game_id)
     if not participants:
-        if not is_continue:
-            await message.answer(f"Игра {game_id} остановлена, но в ней не было участников.")
-        return
+        return f"Игра {game_id} остановлена, но в ней не было участников."
 
-    best_results = await get_best_results(game_id)
     game_data = await get_game(game_id)
 
     if not game_data:
-        if not is_continue:
-            await message.answer("Не удалось получить данные игры.")
-        return
+        return "Не удалось получить данные игры."
     
     true_prompt, _ = game_data
+
+    # Ответы, принятые без оценки (SCORING_MODE=deferred или тайм-аут оценки), оцениваются до выбора победителя
+    await score_pending_results(game_id, true_prompt)
+    winner = await get_game_winner(game_id)
     
     winner_info_for_admin = "🏆 Победитель этого рауунда не определен."
     winner_score = 0
     winner_id = None
-    if best_results:
-        winner = best_results[0]
+    if winner:
         winner_id = winner['user_id']
         winner_username = winner['username'] if winner['username'] else f"user_id: {winner['user_id']}"
         winner_score = winner['score']
@@ -133,24 +162,24 @@ async def stop_game_logic(message: types.Message, bot: Bot, is_continue: bool =
             f"Телефон: {winner_phone}"
         )
 
-    # Рассылка уведомлений о завершении игры участникам
-    for user_id in participants:
-        try:
-            user_score = await get_user_result_for_game(game_id, user_id)
-            
-            message_text = (
-                "Время подвести итоги! Раунд завершён!\n\n"
-                f"Оригинальный промт был: «{true_prompt}»\n\n"
-                f"🏆 В этом раунде победил игрок, набравший {winner_score}%.\n\n"
-                f"Твой результат: {user_score}%\n\n"
-                "Спасибо за участие! До следующей битвы! ✨"
-            )
+    # Рассылка уведомлений о завершении игры участникам.
+    # Лучшие результаты всех участников загружаются одним запросом.
+    user_scores = await get_best_scores(game_id)
+
+    def result_text(user_id):
+        return (
+            "Время подвести итоги! Раунд завершён!\n\n"
+            f"Оригинальный промт был: «{true_prompt}»\n\n"
+            f"🏆 В этом раунде победил игрок, набравший {winner_score}%.\n\n"
+            f"Твой результат: {user_scores.get(user_id) or 0}%\n\n"
+            "Спасибо за участие! До следующей битвы! ✨"
+        )
 
-            await bot.send_message(user_id, message_text)
-        except TelegramForbiddenError:
-            print(f"Не удалось отправить итоги пользователю {user_id}: бот заблокирован.")
-        except Exception as e:
-            print(f"Не удалось отправить итоги пользователю {user_id}: {e}")
+    job.note(f"Игра {game_id} остановлена. Рассылаю итоги участникам ({len(participants)}).")
+
+    title = f"Рассылка итогов игры {game_id}"
+    progress = await send_broadcast(bot, f"results:{game_id}", title, participants, result_text,
+                                    **delivery_options(job, title))
 
     # Отправка информации о победителе админам
     for admin_id in ADMIN_IDS:
@@ -166,19 +195,78 @@ async def stop_game_logic(message: types.Message, bot: Bot, is_continue: bool =
         except Exception as e:
             print(f"Не удалось отправить итоги админу {admin_id}: {e}")
 
-    if not is_continue:
-        await message.answer(f"Игра {game_id} успешно остановлена. Результаты отправлены администраторам.")
+    return (f"Игра {game_id} успешно остановлена. Итоги разосланы {progress.sent} из {progress.total} участников "
+            f"({progress.rate:.0f} сообщ./с), результаты отправлены администраторам.")
+
+async def continue_game_logic(bot: Bot, job: Job):
+    job.note(await stop_game_logic(bot, job))
+    return await start_game_logic(bot, job)
+
+async def score_pending_results(game_id, true_prompt):
+    pending = await get_unscored_results(game_id)
+    if not pending:
+        return
+    profile = build_reference_profile(true_prompt)
+    scores = await scorer.score_many(profile, [prompt_text for _, prompt_text in pending])
+    await update_result_scores([(result_id, score) for (result_id, _), score in zip(pending, scores)])
+    logger.info(f"Оценено {len(pending)} отложенных ответов игры {game_id}")
+
+async def resume_broadcasts(bot: Bot):
+    """Досылает рассылки, прерванные перезапуском бота. Вызывается при старте."""
+    broadcast_ids = await get_unfinished_broadcasts()
+    if not broadcast_ids:
+        return None
+
+    async def logic(job: Job):
+        for broadcast_id in broadcast_ids:
+            record = await get_broadcast(broadcast_id)
+            title = record['title'] or f"Рассылка {record['key']}"
+            progress = await deliver(bot, broadcast_id, **delivery_options(job, title))
+            job.note(f"{title}: доставлено {progress.sent} из {progress.total}.")
+
+    logger.info(f"Досылаю прерванные рассылки: {len(broadcast_ids)}")
+    return jobs.submit("Досылка прерванных рассылок", logic, None, group=ROUND_JOBS)
+
+async def submit_round_job(message: types.Message, bot: Bot, title, logic):
+    # Смена раунда идет в фоне: хендлер сразу возвращается, статус задачи обновляется в одном сообщении
+    try:
+        jobs.submit(title, lambda job: logic(bot, job), message, group=ROUND_JOBS)
+    except JobConflict as e:
+        await message.answer(f"{e}. Дождитесь ее завершения или отмените: /canceljob {e.job.id}")
+
+@admin_router.message(Command("startgame"), F.from_user.id.in_(ADMIN_IDS))
+async def start_game_command(message: types.Message, bot: Bot):
+    await submit_round_job(message, bot, "Запуск игры", start_game_logic)
 
 @admin_router.message(Command("stopgame"), F.from_user.id.in_(ADMIN_IDS))
 async def stop_game_command(message: types.Message, bot: Bot):
-    await stop_game_logic(message, bot)
+    await submit_round_job(message, bot, "Остановка игры", stop_game_logic)
 
 @admin_router.message(Command("continuegame"), F.from_user.id.in_(ADMIN_IDS))
 async def continue_game_command(message: types.Message, bot: Bot):
-    await message.answer("Завершаю текущую игру...")
-    await stop_game_logic(message, bot, is_continue=True)
-    await message.answer("Начинаю следующую игру...")
-    await start_game_logic(message, bot)
+    await submit_round_job(message, bot, "Продолжение игры", continue_game_logic)
+
+@admin_router.message(Command("jobs"), F.from_user.id.in_(ADMIN_IDS))
+async def jobs_command(message: types.Message):
+    recent = jobs.recent()
+    if not recent:
+        await message.answer("Фоновых задач еще не было.")
+        return
+    await message.answer("Фоновые задачи:\n" + "\n".join(job.summary() for job in recent))
+
+@admin_router.message(Command("canceljob"), F.from_user.id.in_(ADMIN_IDS))
+async def cancel_job_command(message: types.Message):
+    try:
+        job_id = int(message.text.split()[1])
+    except (IndexError, ValueError):
+        await message.answer("Неверный формат. Используйте: /canceljob <id>")
+        return
+
+    job = jobs.cancel(job_id)
+    if job is None:
+        await message.answer(f"Задача #{job_id} не найдена или уже завершена.")
+        return
+    await message.answer(f"Задача #{job_id} ({job.title}) отменяется. Уже выполненные шаги не откатываются.")
 
 @admin_router.message(Command("excel"), F.from_user.id.in_(ADMIN_IDS))
 async def excel_export_command(message: types.Message):
@@ -201,45 +289,36 @@ async def select_game_for_export(callback_query: types.CallbackQuery):
     game_id = callback_query.data.split(":")[1]
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
         [types.InlineKeyboardButton(text="Выгрузить лучший результат", callback_data=f"excel_best:{game_id}")],
-        [types.InlineKeyboardButton(text="Выгрузить все результаты", callback_data=f"excel_all:{game_id}")]
+        [types.InlineKeyboardButton(text="Выгрузить все результаты", callback_data=f"excel_all:{game_id}")],
+        [
+            types.InlineKeyboardButton(text="Лучшие (CSV)", callback_data=f"excel_best:{game_id}:csv"),
+            types.InlineKeyboardButton(text="Все (CSV)", callback_data=f"excel_all:{game_id}:csv"),
+            types.InlineKeyboardButton(text="Все (CSV.gz)", callback_data=f"excel_all:{game_id}:csvgz")
+        ]
     ])
     await callback_query.message.edit_text("Выберите тип выгрузки:", reply_markup=keyboard)
     await callback_query.answer()
 
 @admin_router.callback_query(F.data.startswith("excel_"))
 async def excel_export_callback(callback_query: types.CallbackQuery):
-    action, game_id = callback_query.data.split(":")
-    
-    if action == "excel_best":
-        results = await get_best_results(game_id)
-        file_suffix = "best"
-    else:
-        results = await get_all_results(game_id)
-        file_suffix = "all"
-
-    if not results:
+    action, game_id, *rest = callback_query.data.split(":")
+    fmt = rest[0] if rest else "xlsx"
+    kind = "best" if action == "excel_best" else "all"
+
+    # Отвечаем на колбэк сразу: выгрузка большой игры может занять время
+    await callback_query.answer()
+    path, cached = await export_results(game_id, kind, fmt)
+    if not path:
         await callback_query.message.answer("Нет данных для этой игры.")
-        await callback_query.answer()
         return
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = f"Результаты {game_id}"
-    ws.append(["user_id", "ник", "номер телефона", "предложенный промпт", "очки", "время ответа"])
-
-    for row in results:
-        ws.append([row['user_id'], row['username'], row['phone_number'], row['prompt_text'], row['score'], row['timestamp']])
-
-    # Сохраняем файл в байтовый поток в памяти
-    file_stream = io.BytesIO()
-    wb.save(file_stream)
-    file_stream.seek(0) # Перемещаем курсор в начало файла
-
-    file_name = f"results_{game_id}_{file_suffix}.xlsx"
-    await callback_query.message.answer_document(
-        BufferedInputFile(file_stream.read(), filename=file_name)
-    )
-    await callback_query.answer()
+    try:
+        await callback_query.message.answer_document(
+            FSInputFile(path, filename=export_file_name(game_id, kind, fmt))
+        )
+    finally:
+        if not cached:
+            os.remove(path)
 
 from utils.similarity import get_similarity_score
 
@@ -2,13 +2,13 @@ from aiogram import types, Router, F, Bot
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from db.database import (add_result, get_user_attempts, get_game_prompt,
-                         add_participant, get_current_active_game,
-                         get_game, add_or_update_user, get_user_by_id,
-                         update_user_state, update_user_phone)
-from utils.similarity import get_similarity_score
+from db.database import (submit_result, add_participant, add_or_update_user,
+                         update_user_state, update_user_phone, SUBMIT_NO_ATTEMPTS, SUBMIT_GAME_OVER)
+from db.active_game import active_game
+from middlewares.context import UserSession
+from utils.scoring import scorer
 from middlewares.subscription import is_user_subscribed
-from config.config import CHANNEL_ID
+from config.config import CHANNEL_ID, SCORING_MODE
 import re
 
 user_router = Router()
@@ -63,11 +63,10 @@ async def ask_for_phone(message: types.Message):
 # =================================================================================================
 
 @user_router.message(CommandStart())
-async def start_handler(message: types.Message, state: FSMContext, bot: Bot):
+async def start_handler(message: types.Message, state: FSMContext, bot: Bot, session: UserSession):
     await state.clear()
     user = message.from_user
-    db_user = await get_user_by_id(user.id)
-    is_new = not db_user
+    is_new = session.is_new
 
     if is_new:
         await add_or_update_user(user.id, user.username, user.first_name, user.last_name)
@@ -78,13 +77,13 @@ async def start_handler(message: types.Message, state: FSMContext, bot: Bot):
         await ask_for_subscription(message, is_new)
         return
 
-    if not db_user or not db_user['phone_number']:
+    if not session.has_phone:
         await state.set_state(UserState.awaiting_phone_number)
         await ask_for_phone(message)
     else:
         await show_main_menu(message)
 
-@user_router.message(Command("help"))
+@user_router.message(Command("help"), flags={'session': False})
 async def help_handler(message: types.Message):
     help_text = (
         "Привет! Я бот для игры «Битва Промптов».\n\n"
@@ -99,14 +98,15 @@ async def help_handler(message: types.Message):
 
 
 @user_router.callback_query(F.data == 'check_subscription_again')
-async def check_subscription_again_handler(callback_query: types.CallbackQuery, state: FSMContext, bot: Bot):
+async def check_subscription_again_handler(callback_query: types.CallbackQuery, state: FSMContext, bot: Bot,
+                                           session: UserSession):
     user_id = callback_query.from_user.id
-    subscribed = await is_user_subscribed(user_id, bot)
+    # Пользователь говорит, что только что подписался — кешу не доверяем
+    subscribed = await is_user_subscribed(user_id, bot, force=True)
     
     if subscribed:
         await callback_query.message.delete()
-        db_user = await get_user_by_id(user_id)
-        if not db_user or not db_user['phone_number']:
+        if not session.has_phone:
             await state.set_state(UserState.awaiting_phone_number)
             await ask_for_phone(callback_query.message)
         else:
@@ -114,7 +114,7 @@ async def check_subscription_again_handler(callback_query: types.CallbackQuery,
     else:
         await callback_query.answer("Подписка не найдена. Попробуй еще раз.", show_alert=True)
 
-@user_router.message(UserState.awaiting_phone_number, F.contact)
+@user_router.message(UserState.awaiting_phone_number, F.contact, flags={'session': False})
 async def phone_number_handler(message: types.Message, state: FSMContext):
     phone_number = message.contact.phone_number
     await update_user_phone(message.from_user.id, phone_number)
@@ -124,7 +124,7 @@ async def phone_number_handler(message: types.Message, state: FSMContext):
     await show_main_menu(message)
 
 
-@user_router.message(UserState.awaiting_phone_number, F.text)
+@user_router.message(UserState.awaiting_phone_number, F.text, flags={'session': False})
 async def phone_number_text_handler(message: types.Message, state: FSMContext):
     phone_number = message.text
     # Простая проверка на наличие цифр и знака +
@@ -138,9 +138,7 @@ async def phone_number_text_handler(message: types.Message, state: FSMContext):
         await message.answer("Неверный формат номера. Попробуй еще раз, например: +7 999 123 45 67")
 
 async def show_main_menu(message: types.Message):
-    game_id = await get_current_active_game()
-
-    if game_id:
+    if active_game.get():
         text = "Отлично, все готово для старта! Ты готов(а) сыграть прямо сейчас?"
         keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
             [types.InlineKeyboardButton(text="Да, начинаем!", callback_data="play_now")],
@@ -155,22 +153,22 @@ async def show_main_menu(message: types.Message):
 # GAME READINESS AND START
 # =================================================================================================
 
-@user_router.callback_query(F.data == 'play_later')
+@user_router.callback_query(F.data == 'play_later', flags={'session': False})
 async def play_later_handler(callback_query: types.CallbackQuery):
     await callback_query.message.edit_text("Когда будешь готов(а) - просто напиши мне команду /start, и мы начнем.")
     await callback_query.answer()
 
 @user_router.callback_query(F.data == 'play_now')
-async def play_now_handler(callback_query: types.CallbackQuery, state: FSMContext):
-    game_id = await get_current_active_game()
-    if not game_id:
+async def play_now_handler(callback_query: types.CallbackQuery, state: FSMContext, session: UserSession):
+    game = session.game
+    if not game:
         await callback_query.message.edit_text("К сожалению, активная игра только что закончилась. Дождись следующей!")
         await callback_query.answer()
         return
         
+    game_id = game.game_id
     user_id = callback_query.from_user.id
-    attempts = await get_user_attempts(game_id, user_id)
-    if attempts >= MAX_ATTEMPTS:
+    if session.attempts >= MAX_ATTEMPTS:
         await callback_query.message.edit_text("Ты уже принял(а) участие в этом раунде. Жди результатов!")
         await callback_query.answer()
         return
@@ -181,15 +179,9 @@ async def play_now_handler(callback_query: types.CallbackQuery, state: FSMContex
                                          "3. У тебя будет 1 попытка, чтобы предложить свой вариант. Чем точнее твой промпт — тем выше шанс на победу! Внимание! Чтобы все играли честно, я не буду показывать процент схожести до конца раунда.\n"
                                          "Удачи 🏆")
     
-    game_data = await get_game(game_id)
-    if game_data:
-        _, photo_id = game_data
-        await add_participant(game_id, user_id)
-        await callback_query.message.answer_photo(photo_id, caption="Вот изображение. Жду твой вариант промпта!")
-        await state.set_state(UserState.in_game)
-    else:
-        await callback_query.message.answer("Не удалось загрузить игру. Попробуй позже.")
-        
+    await add_participant(game_id, user_id)
+    await callback_query.message.answer_photo(game.photo_id, caption="Вот изображение. Жду твой вариант промпта!")
+    await state.set_state(UserState.in_game)
     await callback_query.answer()
 
 
@@ -197,29 +189,34 @@ async def play_now_handler(callback_query: types.CallbackQuery, state: FSMContex
 # GAME PROCESS
 # =================================================================================================
 
-@user_router.message(UserState.in_game, F.text)
+# Лимит попыток проверяет сама запись ответа, сессия не нужна
+@user_router.message(UserState.in_game, F.text, flags={'session': False})
 async def handle_prompt_submission(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    game_id = await get_current_active_game()
+    game = active_game.get()
 
-    if not game_id:
+    if not game:
         await message.answer("Игра уже закончилась. Напиши /start, чтобы узнать о новых играх.")
         await state.clear()
         return
 
-    attempts = await get_user_attempts(game_id, user_id)
-    if attempts >= MAX_ATTEMPTS:
-        await message.answer("Вы уже использовали свою попытку в этой игре. Ждите результатов!")
-        return
-
-    prompt_text = await get_game_prompt(game_id)
-    if not prompt_text:
-        await message.answer("Эта игра уже завершена. Дождитесь следующего раундов.")
+    game_id = game.game_id
+    if SCORING_MODE == 'deferred':
+        # Оценка будет посчитана пачкой при остановке игры
+        score = None
+    else:
+        # None, если точный подсчет не уложился в SCORER_TIMEOUT: ответ оценится при остановке игры
+        score = await scorer.score(game.profile, message.text)
+    # Лимит попыток и статус игры проверяются в той же транзакции, что и запись ответа:
+    # игру могли остановить, пока ответ оценивался
+    outcome = await submit_result(game_id, user_id, message.from_user.username, message.text, score, MAX_ATTEMPTS)
+    if outcome == SUBMIT_GAME_OVER:
+        await message.answer("Игра уже закончилась. Напиши /start, чтобы узнать о новых играх.")
         await state.clear()
         return
-
-    score = await get_similarity_score(message.text, prompt_text)
-    await add_result(game_id, user_id, message.from_user.username, message.text, score)
+    if outcome == SUBMIT_NO_ATTEMPTS:
+        await message.answer("Вы уже использовали свою попытку в этой игре. Ждите результатов!")
+        return
 
     await message.answer("✅ Спасибо! Твой ответ записан. Жди результатов!")
     await state.clear()
@@ -228,7 +225,7 @@ async def handle_prompt_submission(message: types.Message, state: FSMContext):
 # OTHER HANDLERS
 # =================================================================================================
 
-@user_router.message(F.text)
-async def handle_other_text(message: types.Message, state: FSMContext, bot: Bot):
+@user_router.message(F.text, flags={'throttling': 'text'})
+async def handle_other_text(message: types.Message, state: FSMContext, bot: Bot, session: UserSession):
     # Если пользователь что-то пишет, не находясь в игре, просто предлагаем ему начать
-    await start_handler(message, state, bot)
+    await start_handler(message, state, bot, session)
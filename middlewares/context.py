@@ -0,0 +1,75 @@
+from typing import Callable, Dict, Any, Awaitable, Union
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message, CallbackQuery
+from db.database import get_user_session, reactivate_user
+from db.active_game import active_game
+from db.unreachable import unreachable_users
+
+
+class UserSession:
+    """
+    Данные пользователя для одного обновления: строка users, активная игра
+    и участие пользователя в ней. Загружаются одним запросом в ContextMiddleware.
+    """
+    __slots__ = ('user_id', 'is_new', 'username', 'phone_number', 'state', 'reachable', 'game',
+                 'is_participant', 'attempts')
+
+    def __init__(self, user_id, row, game):
+        self.user_id = user_id
+        self.game = game
+        # Пользователя еще нет в БД: /start от нового пользователя
+        self.is_new = row is None
+        self.username = row['username'] if row else None
+        self.phone_number = row['phone_number'] if row else None
+        self.state = row['state'] if row else None
+        self.reachable = bool(row['reachable']) if row else True
+        # Участие в активной игре; без игры или без записи в participants — не участвует
+        self.is_participant = bool(row) and row['attempts'] is not None
+        self.attempts = row['attempts'] if self.is_participant else 0
+
+    @property
+    def has_phone(self):
+        return bool(self.phone_number)
+
+
+async def load_user_session(user_id):
+    game = active_game.get()
+    row = await get_user_session(user_id, game.game_id if game else None)
+    session = UserSession(user_id, row, game)
+    if not session.reachable:
+        await reactivate(user_id)
+        session.reachable = True
+    return session
+
+
+async def reactivate(user_id):
+    # Пользователь, исключенный из рассылок, снова пишет боту: возвращаем его в рассылки
+    unreachable_users.discard(user_id)
+    await reactivate_user(user_id)
+
+
+class ContextMiddleware(BaseMiddleware):
+    """
+    Загружает UserSession и передает его хендлеру аргументом session.
+
+    Подключается внутренним middleware после ограничения частоты: данные читаются только
+    для обновлений, которые дошли до хендлера. Хендлер, которому сессия не нужна
+    (например, отправка ответа в игре), отключает загрузку флагом flags={'session': False}.
+    Пользователь, исключенный из рассылок, возвращается в них при любом обновлении.
+    Без сессии это решается по множеству unreachable_users в памяти, без запроса к БД.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[Union[Message, CallbackQuery], Dict[str, Any]], Awaitable[Any]],
+        event: Union[Message, CallbackQuery],
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is not None:
+            if get_flag(data, 'session', default=True):
+                data['session'] = await load_user_session(user.id)
+            elif await unreachable_users.contains(user.id):
+                await reactivate(user.id)
+        return await handler(event, data)
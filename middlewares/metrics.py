@@ -0,0 +1,81 @@
+import time
+from typing import Callable, Dict, Any, Awaitable
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject, Update
+from utils.metrics import UPDATE_SECONDS, UPDATE_ERRORS, HANDLER_SECONDS, TELEGRAM_SECONDS, TELEGRAM_ERRORS
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware диспетчера: время обработки каждого обновления целиком, по типу события."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        event_type = event.event_type
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            UPDATE_ERRORS.inc(event_type)
+            raise
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started, event_type)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware: время выполнения конкретного хендлера.
+    Внутренние middleware вызываются уже после выбора хендлера, поэтому его имя известно.
+    """
+
+    def __init__(self, event_type):
+        self.event_type = event_type
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, self.event_type,
+                                    data['handler'].callback.__name__)
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время каждого запроса к Bot API по методу и ошибки по типу."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ):
+        api_method = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, api_method)
+
+
+def setup_metrics(dp):
+    """
+    Подключает замеры к диспетчеру: обновления целиком и каждый хендлер.
+    Внутренние middleware диспетчера действуют и на хендлеры вложенных роутеров.
+    """
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    for event_type, observer in dp.observers.items():
+        if event_type not in ('update', 'error'):
+            observer.middleware(HandlerMetricsMiddleware(event_type))
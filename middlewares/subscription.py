@@ -1,18 +1,126 @@
+import asyncio
+import time
+from collections import OrderedDict
 from typing import Callable, Dict, Any, Awaitable, Union
 from aiogram import BaseMiddleware
 from aiogram import Bot, types
 from aiogram.types import Message, CallbackQuery
-from config.config import CHANNEL_ID
+from config.config import (CHANNEL_ID, SUBSCRIPTION_POSITIVE_TTL, SUBSCRIPTION_NEGATIVE_TTL,
+                           SUBSCRIPTION_CACHE_SIZE)
+from utils.metrics import Counter, Gauge
 
-async def is_user_subscribed(user_id: int, bot: Bot) -> bool:
+
+class SubscriptionCache:
+    """
+    Кеш статуса подписки с разным временем жизни для положительного и отрицательного ответа.
+    Одновременные проверки одного пользователя разделяют один запрос к Telegram.
+    """
+
+    def __init__(self, positive_ttl, negative_ttl, max_size):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    def _lookup(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return value
+
+    def _store(self, user_id, value):
+        ttl = self.positive_ttl if value else self.negative_ttl
+        if ttl <= 0:
+            return
+        self._entries[user_id] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    async def get(self, user_id, fetch, force=False):
+        """
+        fetch — корутина, возвращающая пару (статус, можно_ли_кешировать).
+        force=True пропускает кеш и запрашивает статус заново.
+        """
+        if not force:
+            value = self._lookup(user_id)
+            if value is not None:
+                self.hits += 1
+                return value
+            task = self._inflight.get(user_id)
+            if task is not None:
+                self.coalesced += 1
+                return await asyncio.shield(task)
+
+        self.misses += 1
+        task = asyncio.ensure_future(self._fetch(user_id, fetch))
+        self._inflight[user_id] = task
+        return await asyncio.shield(task)
+
+    async def _fetch(self, user_id, fetch):
+        try:
+            value, cacheable = await fetch()
+            if cacheable:
+                self._store(user_id, value)
+            return value
+        finally:
+            if self._inflight.get(user_id) is asyncio.current_task():
+                del self._inflight[user_id]
+
+    def snapshot(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'size': len(self._entries),
+            'inflight': len(self._inflight),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+
+subscription_cache = SubscriptionCache(SUBSCRIPTION_POSITIVE_TTL, SUBSCRIPTION_NEGATIVE_TTL,
+                                       SUBSCRIPTION_CACHE_SIZE)
+
+
+async def _check_subscription(user_id: int, bot: Bot):
     try:
         member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        return member.status in ['member', 'administrator', 'creator']
+        return member.status in ['member', 'administrator', 'creator'], True
     except Exception as e:
         print(f"Ошибка проверки подписки для user_id {user_id}: {e}")
         # В случае ошибки (например, бот не в канале), считаем, что пользователь подписан,
-        # чтобы не блокировать работу бота.
-        return True
+        # чтобы не блокировать работу бота. Такой ответ не кешируем.
+        return True, False
+
+async def is_user_subscribed(user_id: int, bot: Bot, force: bool = False) -> bool:
+    return await subscription_cache.get(user_id, lambda: _check_subscription(user_id, bot), force=force)
+
+def get_subscription_cache_stats():
+    return subscription_cache.snapshot()
+
+Gauge('subscription_cache_size', "Пользователи в кеше статуса подписки",
+      callback=lambda: get_subscription_cache_stats()['size'])
+Counter('subscription_cache_hits_total', "Проверки подписки, отвеченные из кеша",
+        callback=lambda: get_subscription_cache_stats()['hits'])
+Counter('subscription_cache_misses_total', "Проверки подписки с запросом к Telegram",
+        callback=lambda: get_subscription_cache_stats()['misses'])
+Counter('subscription_cache_coalesced_total', "Проверки подписки, дождавшиеся уже идущего запроса",
+        callback=lambda: get_subscription_cache_stats()['coalesced'])
+Gauge('subscription_cache_hit_rate', "Доля проверок подписки без своего запроса к Telegram",
+      callback=lambda: get_subscription_cache_stats()['hit_rate'])
 
 class SubscriptionMiddleware(BaseMiddleware):
     async def __call__(
@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Any, Awaitable, Union
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message, CallbackQuery
+from config.config import (THROTTLE_RATE, THROTTLE_BURST, THROTTLE_TEXT_RATE, THROTTLE_TEXT_BURST,
+                           THROTTLE_CACHE_SIZE)
+
+# Лимит по умолчанию для игровых действий (команды, кнопки, номер телефона, ответ в игре)
+DEFAULT_LIMIT = 'default'
+
+# Ключ лимита (флаг хендлера throttling) -> (токенов в секунду, размер пачки)
+THROTTLE_LIMITS = {
+    DEFAULT_LIMIT: (THROTTLE_RATE, THROTTLE_BURST),
+    # Произвольный текст вне игры: каждый такой запрос идет в БД и к Telegram, лимит строже
+    'text': (THROTTLE_TEXT_RATE, THROTTLE_TEXT_BURST),
+}
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничение частоты запросов пользователя: token bucket на пару (user_id, ключ лимита).
+
+    Ключ лимита задается флагом хендлера, например flags={'throttling': 'text'};
+    flags={'throttling': None} отключает ограничение. Обновления сверх лимита отбрасываются
+    до вызова хендлера, поэтому не стоят ни запросов к БД, ни запросов к Telegram;
+    на нажатие кнопки отвечаем пустым answer, чтобы у пользователя не висели часики.
+    Корзины хранятся в памяти, их число ограничено max_size (вытесняются давно неактивные).
+    """
+
+    def __init__(self, limits=None, max_size=THROTTLE_CACHE_SIZE):
+        self.limits = limits or THROTTLE_LIMITS
+        self.max_size = max_size
+        self.allowed = 0
+        self.throttled = 0
+        self._buckets = OrderedDict()
+
+    def _take(self, user_id, limit):
+        rate, burst = self.limits.get(limit, self.limits[DEFAULT_LIMIT])
+        now = time.monotonic()
+        key = (user_id, limit)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = burst
+        else:
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+        return allowed
+
+    async def __call__(
+        self,
+        handler: Callable[[Union[Message, CallbackQuery], Dict[str, Any]], Awaitable[Any]],
+        event: Union[Message, CallbackQuery],
+        data: Dict[str, Any]
+    ) -> Any:
+        limit = get_flag(data, 'throttling', default=DEFAULT_LIMIT)
+        user = data.get('event_from_user')
+        if limit is None or user is None:
+            return await handler(event, data)
+
+        if self._take(user.id, limit):
+            self.allowed += 1
+            return await handler(event, data)
+
+        self.throttled += 1
+        if isinstance(event, CallbackQuery):
+            await event.answer()
+        return None
+
+    def snapshot(self):
+        return {
+            'buckets': len(self._buckets),
+            'allowed': self.allowed,
+            'throttled': self.throttled,
+        }
@@ -0,0 +1,372 @@
+# supervisor.py
+"""
+Запуск бота в нескольких процессах.
+
+Супервизор сам получает обновления (long polling или вебхук) и раздает их процессам-воркерам.
+Обновления одного пользователя всегда попадают в один и тот же воркер (по user_id), а внутри
+воркера выполняются строго по очереди, поэтому порядок шагов FSM сохраняется. Обновления
+администраторов закреплены за воркером 0: там выполняются запуск и остановка игр, рассылки
+и выгрузки, а пользователи при нескольких воркерах распределяются по остальным.
+
+Все процессы читают одну конфигурацию (.env) и работают с одной базой SQLite.
+Воркеры периодически сообщают о своем состоянии; упавший воркер перезапускается.
+
+Запуск: python supervisor.py
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from aiohttp import web
+from aiogram import Bot
+from aiogram.methods import GetUpdates
+from app import create_bot, create_dispatcher
+from config.config import (ADMIN_IDS, BOT_MODE, WORKERS, WORKER_CONCURRENCY, WORKER_QUEUE_SIZE,
+                           WORKER_HEALTH_INTERVAL, WEBHOOK_URL, WEBHOOK_PATH,
+                           WEBHOOK_HOST, WEBHOOK_PORT, SCORER_WORKERS)
+from db.active_game import active_game
+from db.database import open_db, init_db, close_db, get_writer_stats
+from utils.scoring import scorer
+from utils.webhook import check_secret, resolve_secret
+
+logger = logging.getLogger(__name__)
+
+POLLING_TIMEOUT = 10
+# Воркер, который не присылал отчет дольше стольких интервалов, считается зависшим
+HEARTBEAT_MISSES = 3
+
+
+def update_user_id(update):
+    """Достает id пользователя из сырого обновления (или id чата, если пользователя нет)."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if user:
+            return user['id']
+        chat = value.get('chat')
+        if chat:
+            return chat['id']
+    return None
+
+
+def route(user_id, workers):
+    """Номер воркера для пользователя: администраторы и обновления без пользователя — воркер 0."""
+    if user_id is None or user_id in ADMIN_IDS or workers == 1:
+        return 0
+    return 1 + user_id % (workers - 1)
+
+
+class UpdateWorker:
+    """
+    Цикл воркера: читает обновления из своей очереди и передает их диспетчеру.
+
+    Одновременно выполняется не больше concurrency обновлений; следующее сообщение из очереди
+    берется только когда освободится слот. Обновление пользователя ждет завершения его
+    предыдущего обновления, поэтому разные пользователи обрабатываются параллельно,
+    а один пользователь — последовательно.
+    """
+
+    def __init__(self, index, dp, bot, updates, events, concurrency=WORKER_CONCURRENCY):
+        self.index = index
+        self.dp = dp
+        self.bot = bot
+        self.updates = updates
+        self.events = events
+        self.concurrency = concurrency
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.started_at = time.time()
+        self._slots = None
+        # Последняя задача каждого пользователя: следующее его обновление выполнится после нее
+        self._tails = {}
+
+    def _get(self):
+        try:
+            return self.updates.get(timeout=1)
+        except queue.Empty:
+            return ...
+
+    async def run(self):
+        self._slots = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+        health = asyncio.create_task(self._health_loop())
+        try:
+            while True:
+                await self._slots.acquire()
+                message = await loop.run_in_executor(None, self._get)
+                if message is ...:
+                    self._slots.release()
+                    continue
+                if message is None:
+                    self._slots.release()
+                    break
+                if message[0] == 'update':
+                    self._dispatch(message[1], message[2])
+                else:
+                    self._slots.release()
+                    if message[0] == 'reload_game':
+                        await active_game.reload(notify=False)
+            await asyncio.gather(*self._tails.values(), return_exceptions=True)
+        finally:
+            health.cancel()
+
+    def _dispatch(self, user_id, update):
+        self.in_flight += 1
+        previous = self._tails.get(user_id)
+        task = asyncio.create_task(self._process(previous, update))
+        self._tails[user_id] = task
+        task.add_done_callback(lambda _: self._forget(user_id, task))
+
+    def _forget(self, user_id, task):
+        if self._tails.get(user_id) is task:
+            del self._tails[user_id]
+
+    async def _process(self, previous, update):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await self.dp.feed_raw_update(self.bot, update)
+        except Exception:
+            self.failed += 1
+            logger.exception(f"Воркер {self.index}: ошибка обработки обновления")
+        finally:
+            self.processed += 1
+            self.in_flight -= 1
+            self._slots.release()
+
+    def snapshot(self):
+        return {
+            'pid': os.getpid(),
+            'uptime': round(time.time() - self.started_at, 1),
+            'processed': self.processed,
+            'failed': self.failed,
+            'in_flight': self.in_flight,
+            'users_in_flight': len(self._tails),
+            'writer_queue': get_writer_stats()['queue_depth'],
+            'scorer_in_flight': scorer.in_flight,
+            'scorer_timeouts': scorer.timeouts,
+        }
+
+    async def _health_loop(self):
+        while True:
+            self.events.put(('health', self.index, self.snapshot()))
+            await asyncio.sleep(WORKER_HEALTH_INTERVAL)
+
+
+async def _run_worker(index, updates, events, scorer_workers):
+    # Пул оценки делится между воркерами: иначе каждый поднял бы процессы по числу ядер
+    scorer.workers = scorer_workers
+    bot = create_bot()
+    dp = create_dispatcher()
+    await dp.emit_startup(bot=bot, worker_index=index)
+    # Игру меняет администратор в своем воркере; остальные должны перечитать кеш
+    active_game.subscribe(lambda: events.put(('game_changed', index)))
+    try:
+        await UpdateWorker(index, dp, bot, updates, events).run()
+    finally:
+        try:
+            await dp.emit_shutdown(bot=bot, worker_index=index)
+        finally:
+            await bot.session.close()
+
+
+def worker_main(index, updates, events, scorer_workers):
+    # Остановкой управляет супервизор: Ctrl+C в терминале не должен ронять воркеры по отдельности
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, updates, events, scorer_workers))
+
+
+class Supervisor:
+    def __init__(self, workers=WORKERS):
+        self.workers = workers or os.cpu_count() or 1
+        # SCORER_WORKERS (или число ядер) — на все воркеры вместе, а не на каждый
+        self.scorer_workers = max(1, (SCORER_WORKERS or os.cpu_count() or 1) // self.workers)
+        self._context = multiprocessing.get_context('spawn')
+        self.events = self._context.Queue()
+        self.queues = []
+        self.processes = []
+        self.health = {}
+        self.restarts = [0] * self.workers
+        self.routed = [0] * self.workers
+        self.rejected = 0
+
+    def _spawn(self, index):
+        # Очередь каждый раз новая: упавший процесс мог оставить старую очередь заблокированной
+        updates = self._context.Queue(maxsize=WORKER_QUEUE_SIZE)
+        process = self._context.Process(
+            target=worker_main, args=(index, updates, self.events, self.scorer_workers),
+            name=f"worker-{index}"
+        )
+        process.start()
+        return updates, process
+
+    def start(self):
+        for index in range(self.workers):
+            updates, process = self._spawn(index)
+            self.queues.append(updates)
+            self.processes.append(process)
+        logger.info(f"Запущено воркеров: {self.workers}, оценок на воркер: {self.scorer_workers}")
+
+    def stop(self, timeout=30):
+        for updates in self.queues:
+            updates.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"{process.name} не завершился вовремя, останавливаю принудительно")
+                process.terminate()
+                process.join()
+
+    def offer(self, update):
+        """Передает обновление воркеру без ожидания; False, если его очередь заполнена."""
+        user_id = update_user_id(update)
+        index = route(user_id, self.workers)
+        try:
+            self.queues[index].put_nowait(('update', user_id, update))
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.routed[index] += 1
+        return True
+
+    async def put(self, update):
+        """Передает обновление воркеру, дожидаясь места в его очереди."""
+        while not self.offer(update):
+            await asyncio.sleep(0.05)
+
+    def broadcast(self, message, exclude=None):
+        for index, updates in enumerate(self.queues):
+            if index != exclude:
+                updates.put(message)
+
+    def _read_event(self):
+        try:
+            return self.events.get(timeout=1)
+        except queue.Empty:
+            return None
+
+    async def events_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await loop.run_in_executor(None, self._read_event)
+            if event is None:
+                continue
+            if event[0] == 'health':
+                self.health[event[1]] = (time.monotonic(), event[2])
+            elif event[0] == 'game_changed':
+                self.broadcast(('reload_game',), exclude=event[1])
+
+    async def health_loop(self):
+        while True:
+            await asyncio.sleep(WORKER_HEALTH_INTERVAL)
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error(f"{process.name} завершился с кодом {process.exitcode}, перезапускаю")
+                    self.restarts[index] += 1
+                    self.health.pop(index, None)
+                    self.queues[index], self.processes[index] = self._spawn(index)
+                    continue
+                reported_at, stats = self.health.get(index, (None, None))
+                if stats is None:
+                    continue
+                if now - reported_at > WORKER_HEALTH_INTERVAL * HEARTBEAT_MISSES:
+                    logger.warning(f"{process.name} не присылал отчет {now - reported_at:.0f} с")
+                logger.info(
+                    f"{process.name}: pid={stats['pid']} обработано={stats['processed']} "
+                    f"ошибок={stats['failed']} в работе={stats['in_flight']} "
+                    f"направлено={self.routed[index]} перезапусков={self.restarts[index]} "
+                    f"очередь записи={stats['writer_queue']} "
+                    f"на оценке={stats['scorer_in_flight']} тайм-аутов оценки={stats['scorer_timeouts']}"
+                )
+
+
+async def poll_updates(supervisor: Supervisor, bot: Bot, allowed_updates):
+    # Если раньше бот работал через вебхук, getUpdates вернет ошибку, пока вебхук не снят
+    await bot.delete_webhook()
+    get_updates = GetUpdates(timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates)
+    while True:
+        try:
+            updates = await bot(get_updates, request_timeout=POLLING_TIMEOUT + 10)
+        except Exception as e:
+            logger.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await supervisor.put(update.model_dump(mode='json', by_alias=True, exclude_none=True))
+            get_updates.offset = update.update_id + 1
+
+
+async def serve_webhook(supervisor: Supervisor, bot: Bot, allowed_updates):
+    secret = resolve_secret()
+
+    async def handle(request: web.Request):
+        if not check_secret(request, secret):
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        # Очередь воркера заполнена — Telegram повторит доставку позже
+        return web.Response(status=200 if supervisor.offer(update) else 503)
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=secret,
+            allowed_updates=allowed_updates,
+        )
+    logger.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Future()
+    finally:
+        await runner.cleanup()
+
+
+async def main():
+    # Миграции применяются один раз до запуска воркеров
+    await open_db()
+    await init_db()
+    await close_db()
+
+    bot = create_bot()
+    allowed_updates = create_dispatcher().resolve_used_update_types()
+    supervisor = Supervisor()
+    supervisor.start()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signame in ('SIGINT', 'SIGTERM'):
+        loop.add_signal_handler(getattr(signal, signame), stop_event.set)
+
+    intake = serve_webhook if BOT_MODE == 'webhook' else poll_updates
+    tasks = [
+        asyncio.create_task(intake(supervisor, bot, allowed_updates)),
+        asyncio.create_task(supervisor.events_loop()),
+        asyncio.create_task(supervisor.health_loop()),
+    ]
+    try:
+        await stop_event.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Воркеры дорабатывают уже полученные обновления и закрывают свои соединения
+        await loop.run_in_executor(None, supervisor.stop)
+        await bot.session.close()
+        logger.info("Супервизор остановлен")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
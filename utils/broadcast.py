@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import random
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import (TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+                                TelegramRetryAfter, TelegramServerError)
+from config.config import (BROADCAST_RATE, BROADCAST_PER_CHAT_INTERVAL, BROADCAST_CONCURRENCY,
+                           BROADCAST_MAX_RETRIES, BROADCAST_PROGRESS_INTERVAL, BROADCAST_CLAIM_BATCH)
+from db.database import (create_broadcast, get_broadcast, claim_outbox, mark_outbox, requeue_outbox,
+                         get_outbox_counts, finish_broadcast)
+from db.unreachable import unreachable_users
+
+logger = logging.getLogger(__name__)
+
+# Исходы отправки одного сообщения
+SENT = 'sent'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+
+# Ответы Bot API, которые относятся к самому чату и не пройдут при повторе
+PERMANENT_ERRORS = ('chat not found', 'user is deactivated')
+
+
+def is_permanent(outcome, error):
+    """
+    Считается ли неудача признаком того, что пользователь недоступен. Только такие неудачи
+    исключают пользователя из рассылок; исчерпанные повторы после flood control, сетевых ошибок
+    и ошибок сервера Telegram говорят о сбое Telegram, а не о получателе.
+    """
+    if outcome == BLOCKED:
+        return True
+    return isinstance(error, TelegramBadRequest) and any(text in str(error).lower() for text in PERMANENT_ERRORS)
+
+
+class TokenBucket:
+    """
+    Глобальный ограничитель скорости: не больше rate сообщений в секунду
+    с допустимым всплеском capacity. После TelegramRetryAfter ведро ставится на паузу.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # Создается лениво: на Python 3.9 примитивы asyncio привязываются к циклу при создании
+        self._lock = None
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PerChatLimiter:
+    """
+    Ограничение на один чат: между сообщениями в один и тот же чат
+    проходит не меньше interval секунд (лимит Telegram — около 1 сообщения в секунду).
+    """
+
+    def __init__(self, interval, max_chats=100_000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self._next_at = {}
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        next_at = self._next_at.get(chat_id, 0.0)
+        self._next_at[chat_id] = max(now, next_at) + self.interval
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+        if len(self._next_at) > self.max_chats:
+            self._prune(now)
+
+    def _prune(self, now):
+        self._next_at = {chat_id: at for chat_id, at in self._next_at.items() if at > now}
+
+
+# Лимиты общие для всех рассылок процесса: итоги раунда и анонс следующего идут подряд
+global_bucket = TokenBucket(BROADCAST_RATE)
+per_chat_limiter = PerChatLimiter(BROADCAST_PER_CHAT_INTERVAL)
+
+
+class BroadcastProgress:
+    __slots__ = ('total', 'sent', 'failed', 'blocked', 'resumed', 'started_at', 'finished_at')
+
+    def __init__(self, total):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        # Сколько получателей было обработано до перезапуска: в скорость этого прогона не входят
+        self.resumed = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def processed(self):
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def eta(self):
+        """Оценка оставшегося времени в секундах по текущей скорости."""
+        if self.done:
+            return 0.0
+        if self.processed <= self.resumed:
+            return None
+        return (self.total - self.processed) / self.rate
+
+    def record(self, outcome):
+        if outcome == SENT:
+            self.sent += 1
+        elif outcome == BLOCKED:
+            self.blocked += 1
+        else:
+            self.failed += 1
+
+    @property
+    def rate(self):
+        """Сообщений в секунду за время этого прогона."""
+        return (self.processed - self.resumed) / self.elapsed if self.elapsed > 0 else 0.0
+
+    def format(self, title="Рассылка"):
+        text = (
+            f"{title}: {self.processed} из {self.total}\n"
+            f"✅ Доставлено: {self.sent}\n"
+            f"⛔ Заблокировали бота: {self.blocked}\n"
+            f"⚠️ Ошибки: {self.failed}"
+        )
+        if self.done:
+            text += f"\nЗавершено за {self.elapsed:.0f} с."
+        elif self.eta is not None:
+            text += f"\nОсталось примерно {self.eta:.0f} с."
+        return text
+
+
+async def send_with_retry(bot: Bot, chat_id, text, max_retries=BROADCAST_MAX_RETRIES, **kwargs):
+    """
+    Отправляет одно сообщение с учетом глобального и поканального лимитов.
+    Возвращает исход (SENT, BLOCKED или FAILED) и последнюю ошибку.
+    """
+    attempt = 0
+    while True:
+        await global_bucket.acquire()
+        await per_chat_limiter.wait(chat_id)
+        try:
+            await bot.send_message(chat_id, text, **kwargs)
+            return SENT, None
+        except TelegramRetryAfter as e:
+            # Telegram сам говорит, сколько ждать: останавливаем всю рассылку, а не только этот чат
+            logger.warning(f"Flood control, пауза {e.retry_after} с.")
+            global_bucket.pause(e.retry_after)
+            error = e
+        except TelegramForbiddenError as e:
+            return BLOCKED, e
+        except (TelegramNetworkError, TelegramServerError) as e:
+            error = e
+            # Экспоненциальная задержка с джиттером, чтобы повторы не шли одной волной
+            await asyncio.sleep(min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+        except Exception as e:
+            return FAILED, e
+        attempt += 1
+        if attempt > max_retries:
+            return FAILED, error
+
+
+async def send_broadcast(bot: Bot, key, title, chat_ids, text, on_progress=None, **kwargs):
+    """
+    Рассылка через очередь в БД (outbox): получатели записываются одной транзакцией,
+    затем доставляются функцией deliver. key делает рассылку идемпотентной: если рассылка
+    с таким ключом уже создана (например, до перезапуска), новые получатели не добавляются,
+    а доставка продолжается с того места, где остановилась.
+    """
+    if callable(text):
+        recipients = [(chat_id, text(chat_id)) for chat_id in chat_ids]
+        text = None
+    else:
+        recipients = [(chat_id, None) for chat_id in chat_ids]
+    broadcast_id, created = await create_broadcast(key, title, text, recipients)
+    if not created:
+        logger.info(f"Рассылка {key} уже создана, продолжаю доставку")
+    return await deliver(bot, broadcast_id, on_progress=on_progress, **kwargs)
+
+
+async def deliver(bot: Bot, broadcast_id, on_progress=None, abandon_on_cancel=None,
+                  progress_interval=BROADCAST_PROGRESS_INTERVAL, concurrency=BROADCAST_CONCURRENCY,
+                  batch_size=BROADCAST_CLAIM_BATCH, **kwargs):
+    """
+    Доставляет рассылку из outbox пачками по batch_size получателей. Исход каждой пачки
+    фиксируется в БД, поэтому после сбоя доставка продолжается с первой незафиксированной пачки
+    (ее получатели могут получить сообщение повторно).
+
+    При отмене вызывается abandon_on_cancel: если он вернул True (отмена администратором),
+    рассылка завершается и оставшиеся получатели не получат сообщение и после перезапуска.
+    Иначе (остановка бота) неотправленные получатели возвращаются в очередь, и рассылка
+    продолжится при следующем запуске.
+    """
+    record = await get_broadcast(broadcast_id)
+    progress = BroadcastProgress(record['total'])
+    if record['finished_at'] is not None:
+        progress.sent, progress.blocked, progress.failed = record['sent'], record['blocked'], record['failed']
+        progress.resumed = progress.processed
+        progress.finished_at = time.monotonic()
+        await _report(on_progress, progress)
+        return progress
+
+    requeued = await requeue_outbox(broadcast_id)
+    if requeued:
+        logger.warning(f"Рассылка {broadcast_id}: {requeued} получателей взяты до сбоя, отправляю им заново")
+    counts = await get_outbox_counts(broadcast_id)
+    progress.sent, progress.blocked, progress.failed = counts.get(SENT, 0), counts.get(BLOCKED, 0), counts.get(FAILED, 0)
+    progress.resumed = progress.processed
+
+    reporter_task = _start_reporter(on_progress, progress, progress_interval)
+    default_text = record['text']
+    try:
+        while True:
+            batch = await claim_outbox(broadcast_id, batch_size)
+            if not batch:
+                break
+            outcomes = []
+            try:
+                await _send_all(bot, ((chat_id, chat_text or default_text) for chat_id, chat_text in batch),
+                                progress, concurrency, outcomes, **kwargs)
+            finally:
+                unreachable_users.add(await mark_outbox(broadcast_id, outcomes))
+    except asyncio.CancelledError:
+        if abandon_on_cancel is not None and abandon_on_cancel():
+            await finish_broadcast(broadcast_id)
+        else:
+            await requeue_outbox(broadcast_id)
+        raise
+    finally:
+        progress.finished_at = time.monotonic()
+        if reporter_task:
+            reporter_task.cancel()
+    await finish_broadcast(broadcast_id)
+    await _report(on_progress, progress)
+    return progress
+
+
+async def _send_all(bot: Bot, messages, progress, concurrency, outcomes, **kwargs):
+    """Отправляет пары (chat_id, текст) в concurrency потоков; исходы добавляются в outcomes."""
+    messages = list(messages)
+    pending = iter(messages)
+
+    async def worker():
+        for chat_id, text in pending:
+            outcome, error = await send_with_retry(bot, chat_id, text, **kwargs)
+            if error is not None:
+                logger.info(f"Не удалось отправить сообщение пользователю {chat_id}: {error}")
+            progress.record(outcome)
+            outcomes.append((chat_id, outcome, str(error) if error is not None else None,
+                             is_permanent(outcome, error)))
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(messages))))))
+
+
+def _start_reporter(on_progress, progress, interval):
+    if on_progress is None:
+        return None
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(interval)
+            await _report(on_progress, progress)
+
+    return asyncio.create_task(reporter())
+
+
+async def _report(on_progress, progress):
+    if on_progress is None:
+        return
+    try:
+        await on_progress(progress)
+    except Exception as e:
+        logger.warning(f"Не удалось обновить прогресс рассылки: {e}")
